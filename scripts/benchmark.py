@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""Measure the grading pipeline's throughput against fake machines.
+
+Synthetic projects and submissions are graded by the verification worker and
+a WorkerProxy (or, with --pool, a WorkerPool) whose machines are directories
+on this host in which `worker.py` runs just as it would over ssh. Each step
+that would cross the network is delayed by --latency seconds. With --backend
+remote the configured worker_machines are used instead, over ssh and rsync
+as the --account worker account.
+
+Configuration is read from the optional config_uri (e.g., development.ini)
+while the database and file directory are always scratch copies, thus the
+benchmark never touches real data.
+
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import transaction
+from argparse import ArgumentParser
+from pyramid.paster import get_appsettings
+from pyramid.settings import aslist
+from sqlalchemy import engine_from_config
+from submit import workers
+from submit.models import (Class, File, FileVerifier, Group, Project,
+                           Session, Submission, SubmissionToFile, TestCase,
+                           Testable, User, UserToGroup, configure_sql,
+                           create_schema)
+from submit.workers import proxy as proxy_module, verification
+from submit.workers.backends import LocalBackend
+from submit.workers.metrics import REGISTRY as metrics
+from submit.workers.pool import WorkerPool, in_transaction
+from submit.workers.proxy import WorkerProxy
+
+MAKEFILE = 'prog: prog.sh\n\tcp prog.sh prog && chmod +x prog\n'
+PROGRAM = '#!/bin/sh\n# {0}\n[ -n "$2" ] && sleep $2\necho $(( $1 * $1 ))\n'
+WRONG_PROGRAM = '#!/bin/sh\n# {0}\n[ -n "$2" ] && sleep $2\necho $1\n'
+
+
+class FakeMachineBackend(LocalBackend):
+
+    """A LocalBackend whose network steps each take `latency` seconds."""
+
+    def __init__(self, root, latency=0.):
+        super(FakeMachineBackend, self).__init__(root)
+        self.latency = latency
+
+    def ping(self, machine):
+        time.sleep(self.latency)
+        return self.latency
+
+    def prepare(self, machine):
+        time.sleep(self.latency)
+        return self.latency
+
+    def push(self, machine, path='.'):
+        time.sleep(2 * self.latency)  # rsync's handshake and transfer
+        super(FakeMachineBackend, self).push(machine, path)
+
+    def run(self, machine):
+        time.sleep(self.latency)
+        return super(FakeMachineBackend, self).run(machine)
+
+
+def generate(base_path, projects, testables, test_cases, submissions,
+             wrong=.2, slow=0.):
+    """Create synthetic projects and submissions and return the latter's ids.
+
+    Each testable's test cases check the square of a number. A `wrong`
+    fraction of the submissions print the wrong output so that diffs are
+    computed and stored. Each test case of every project's first testable
+    sleeps for `slow` seconds.
+
+    """
+    class_ = Class(name='Benchmark')
+    makefile = File.fetch_or_create(MAKEFILE, base_path)
+    user = User(name='Benchmark', username='benchmark', password='')
+    Session.add_all([class_, user])
+    project_list = []
+    for i in range(projects):
+        project = Project(name='Project {0}'.format(i), class_=class_,
+                          makefile=makefile)
+        verifier = FileVerifier(filename='prog.sh', min_size=1, min_lines=1,
+                                project=project)
+        for j in range(testables):
+            testable = Testable(name='Testable {0}'.format(j),
+                                executable='prog', make_target='prog',
+                                project=project, file_verifiers=[verifier])
+            for k in range(test_cases):
+                expected = File.fetch_or_create('{0}\n'.format(k * k),
+                                                base_path)
+                args = 'prog {0}'.format(k)
+                if slow and j == 0:
+                    args += ' {0}'.format(slow)
+                Session.add(TestCase(name='Test {0}'.format(k), args=args,
+                                     expected=expected, points=1,
+                                     testable=testable))
+        group = Group(project=project)
+        Session.add(UserToGroup(group=group, project=project, user=user))
+        project_list.append((project, group))
+    submission_list = []
+    for i in range(submissions):
+        project, group = project_list[i % projects]
+        # Numbering the source makes every submission distinct
+        source = (WRONG_PROGRAM if i < submissions * wrong else PROGRAM)
+        submission = Submission(created_by=user, group=group,
+                                project=project)
+        Session.add(SubmissionToFile(
+            filename='prog.sh', submission=submission,
+            file=File.fetch_or_create(source.format(i), base_path)))
+        submission_list.append(submission)
+    Session.flush()
+    submission_ids = [x.id for x in submission_list]
+    transaction.commit()
+    return submission_ids
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def grade(settings, jobs, account, pool=False, one_by_one=False):
+    """Grade the jobs and return their (latencies, errors, elapsed).
+
+    With `one_by_one` each job is handed to the proxy's do_work, just as the
+    standalone proxy receives it from the queue.
+
+    """
+    latencies = []
+    errors = 0
+    start = time.time()
+    if pool:
+        worker_pool = WorkerPool(settings, [account])
+        if worker_pool.estimator:
+            worker_pool.db.apply(in_transaction,
+                                 (worker_pool.estimator.refresh, jobs))
+        worker_pool.start()
+        for index, job in enumerate(jobs):
+            worker_pool.pending.put((index, job))
+        for _ in jobs:
+            _, job, error = worker_pool.done.get()
+            latencies.append(time.time() - job['queued_at'])
+            errors += bool(error)
+    else:
+        proxy = WorkerProxy(settings, account)
+        if one_by_one:
+            batches = [[x] for x in jobs]
+        else:
+            batches = [jobs[i:i + proxy.batch_size]
+                       for i in range(0, len(jobs), proxy.batch_size)]
+        for batch in batches:
+            try:
+                if one_by_one:
+                    proxy.do_work(**batch[0])
+                else:
+                    errors += sum(bool(x) for x in proxy.do_batch(batch))
+            except Exception:
+                errors += len(batch)
+            now = time.time()
+            latencies.extend(now - x['queued_at'] for x in batch)
+    return latencies, errors, time.time() - start
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('config_uri', nargs='?',
+                        help='the configuration providing worker_* settings')
+    parser.add_argument('--submissions', type=int, default=50)
+    parser.add_argument('--projects', type=int, default=2)
+    parser.add_argument('--testables', type=int, default=2)
+    parser.add_argument('--test-cases', type=int, default=10)
+    parser.add_argument('--backend', choices=('local', 'remote'),
+                        default='local',
+                        help='grade on fake machines or on the configured '
+                        'worker_machines over ssh')
+    parser.add_argument('--account', default='benchmark',
+                        help='the worker account used with --backend remote')
+    parser.add_argument('--machines', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='seconds added to each network step')
+    parser.add_argument('--pool', action='store_true',
+                        help='grade with a WorkerPool rather than a proxy')
+    parser.add_argument('--shortest-first', action='store_true',
+                        help='have the WorkerPool run short jobs first')
+    parser.add_argument('--slow', type=float, default=0.,
+                        help='seconds each test case of the first testable '
+                        'of every project sleeps')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='submissions graded before measuring, e.g., '
+                        'to record the durations of past runs')
+    parser.add_argument('--superseded', action='store_true',
+                        help='defer the jobs of superseded submissions, '
+                        'handing the proxy one job at a time')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+    if args.pool and args.superseded:
+        parser.error('--superseded applies to a single proxy')
+    if args.backend == 'remote' and not args.config_uri:
+        parser.error('--backend remote needs the config_uri')
+
+    settings = {}
+    if args.config_uri:
+        settings.update(get_appsettings(args.config_uri, 'main'))
+    scratch = tempfile.mkdtemp(prefix='submit_benchmark_')
+    settings.update({
+        'file_directory': os.path.join(scratch, 'files'),
+        'queue_server': settings.get('queue_server', 'localhost'),
+        'queue_tell_worker': 'benchmark',
+        'sqlalchemy.url': 'sqlite:///{0}'.format(
+            os.path.join(scratch, 'benchmark.sqlite')),
+        'worker_pool_db_threads': 1,  # sqlite allows a single writer
+        'worker_pool_shortest_first': args.shortest_first})
+    if args.backend == 'remote':
+        settings['worker_backend'] = 'remote'
+        settings['worker_machines'] = aslist(settings['worker_machines'])
+    else:
+        settings.update({
+            'worker_local_root': os.path.join(scratch, 'machines'),
+            'worker_machines': ['host{0}'.format(x)
+                                for x in range(args.machines)]})
+        # The synthetic submissions are trusted, thus unlike the `local`
+        # backend the fake machines run the Worker as the current user
+        proxy_module.backend_from_settings = lambda settings, account: \
+            FakeMachineBackend(settings['worker_local_root'], args.latency)
+    if args.superseded:  # The standalone proxy's default
+        settings['worker_batch_size'] = 1
+    workers.BASE_FILE_PATH = settings['file_directory']
+    workers.REUSE_RESULTS = False
+    workers.SUPERSEDED = 'grade'  # Each group submits repeatedly
+    try:
+        configure_sql(engine_from_config(settings, 'sqlalchemy.'))
+        create_schema()
+        submission_ids = generate(settings['file_directory'], args.projects,
+                                  args.testables, args.test_cases,
+                                  args.warmup + args.submissions,
+                                  slow=args.slow)
+        if args.warmup:
+            warmup = []
+            for submission_id in submission_ids[:args.warmup]:
+                warmup.extend(verification.do_work(submission_id) or [])
+            grade(settings, warmup, args.account, pool=args.pool)
+            submission_ids = submission_ids[args.warmup:]
+            metrics.reset()
+
+        start = time.time()
+        jobs = []
+        for submission_id in submission_ids:
+            jobs.extend(verification.do_work(submission_id) or [])
+        verified = time.time() - start
+
+        if args.superseded:  # All but each group's last submission
+            workers.SUPERSEDED = 'defer'
+        latencies, errors, elapsed = grade(settings, jobs, args.account,
+                                           pool=args.pool,
+                                           one_by_one=args.superseded)
+    finally:
+        shutil.rmtree(scratch)
+
+    report = {'errors': errors, 'jobs': len(jobs),
+              'jobs_per_second': len(jobs) / elapsed if elapsed else 0.,
+              'p50': percentile(latencies, .5),
+              'p95': percentile(latencies, .95),
+              'phases': {x: {'count': y[0], 'seconds': y[1]}
+                         for x, y in metrics.totals().items()},
+              'verification_seconds': verified}
+    print('{0} jobs ({1} errors) in {2:.2f}s: {3:.2f} jobs/s'.format(
+        len(jobs), errors, elapsed, report['jobs_per_second']))
+    print('latency p50 {0:.3f}s p95 {1:.3f}s'.format(report['p50'],
+                                                     report['p95']))
+    print('{0:<24} {1:>8} {2:>10} {3:>10}'.format('phase', 'count',
+                                                  'total (s)', 'mean (s)'))
+    for phase, (count, total) in sorted(metrics.totals().items(),
+                                        key=lambda x: -x[1][1]):
+        print('{0:<24} {1:>8} {2:>10.3f} {3:>10.4f}'.format(
+            phase, count, total, total / count))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=4, sort_keys=True)
+    return 1 if args.superseded and errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -46,7 +46,9 @@ setup(name=PACKAGE_NAME,
       [paste.app_factory]
       main = {package}:main
       [console_scripts]
+      regrade_campaigns = {package}.workers.campaign:main
       worker_verification = {package}.workers.verification:main
+      worker_pool = {package}.workers.pool:main
       worker_proxy = {package}.workers.proxy:main
       """.format(package=PACKAGE_NAME),
       extras_require={'dev': ['flake8', 'pyramid_debugtoolbar', 'waitress'],
@@ -47,7 +47,10 @@ def add_routes(config):
     config.add_route('project_item_detailed', '/p/{project_id}/g/{group_id}')
     config.add_route('project_item_detailed_user',
                      '/p/{project_id}/u/{username}')
+    config.add_route('project_resources', '/p/{project_id}/resources')
     config.add_route('project_scores', '/p/{project_id}/scores')
+    config.add_route('regrade_campaign_item',
+                     '/regrade_campaign/{regrade_campaign_id}')
     config.add_route('session', '/session')
     config.add_route('submission', '/submission')
     config.add_route('submission_item', '/submission/{submission_id}')
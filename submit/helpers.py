@@ -4,6 +4,7 @@ import ldap
 import pickle
 import pika
 import re
+import time
 import traceback
 from pyramid_addons.helpers import http_created, http_ok
 from pyramid_addons.validation import (SOURCE_MATCHDICT, EmailAddress,
@@ -320,6 +321,7 @@ def get_queue_func(request):
         conn.close()
 
     def queue_func(**kwargs):
+        kwargs.setdefault('queued_at', time.time())  # Measures queue waits
         return conn.channel().basic_publish(
             exchange='', body=json.dumps(kwargs), routing_key=queue,
             properties=pika.BasicProperties(delivery_mode=2))
@@ -0,0 +1,23 @@
+"""Add time_limit to testcase
+
+Revision ID: 2e6f3a9b7c1d
+Revises: 51c7e5d09a3b
+Create Date: 2026-10-17 11:37:05.902146
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e6f3a9b7c1d'
+down_revision = '51c7e5d09a3b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('testcase',
+                  sa.Column('time_limit', sa.Float(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('testcase', 'time_limit')
@@ -0,0 +1,27 @@
+"""Add fingerprint to testableresult
+
+Revision ID: 3b1f0a8c2d4e
+Revises: 4ae1e9a2ff2
+Create Date: 2026-10-17 09:12:41.318206
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b1f0a8c2d4e'
+down_revision = '4ae1e9a2ff2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('testableresult',
+                  sa.Column('fingerprint', sa.String(), nullable=True))
+    op.create_index('ix_testableresult_fingerprint', 'testableresult',
+                    ['fingerprint'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_testableresult_fingerprint',
+                  table_name='testableresult')
+    op.drop_column('testableresult', 'fingerprint')
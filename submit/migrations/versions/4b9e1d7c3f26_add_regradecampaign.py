@@ -0,0 +1,40 @@
+"""Add RegradeCampaign
+
+Revision ID: 4b9e1d7c3f26
+Revises: 6d2c8e4f1a7b
+Create Date: 2026-10-17 15:21:37.904612
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b9e1d7c3f26'
+down_revision = '6d2c8e4f1a7b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'regradecampaign',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('created_by_id', sa.Integer(), nullable=False),
+        sa.Column('idle_threshold', sa.Integer(), nullable=False),
+        sa.Column('pending', sa.UnicodeText(), nullable=False),
+        sa.Column('project_id', sa.Integer(), nullable=False),
+        sa.Column('queued', sa.Integer(), nullable=False),
+        sa.Column('rate', sa.Float(), nullable=False),
+        sa.Column('running_time', sa.Float(), nullable=False),
+        sa.Column('status', sa.Enum('done', 'paused', 'running',
+                                    name='campaign_status'),
+                  nullable=False),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['created_by_id'], [u'user.id'], ),
+        sa.ForeignKeyConstraint(['project_id'], [u'project.id'], ),
+        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('regradecampaign')
+    sa.Enum(name='campaign_status').drop(op.get_bind(), checkfirst=False)
@@ -0,0 +1,35 @@
+"""Add resource usage to testcaseresult
+
+Revision ID: 51c7e5d09a3b
+Revises: 3b1f0a8c2d4e
+Create Date: 2026-10-17 10:04:22.581734
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '51c7e5d09a3b'
+down_revision = '3b1f0a8c2d4e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('testcaseresult',
+                  sa.Column('cpu_system', sa.Float(), nullable=True))
+    op.add_column('testcaseresult',
+                  sa.Column('cpu_user', sa.Float(), nullable=True))
+    op.add_column('testcaseresult',
+                  sa.Column('max_rss', sa.Integer(), nullable=True))
+    op.add_column('testcaseresult',
+                  sa.Column('output_bytes', sa.Integer(), nullable=True))
+    op.add_column('testcaseresult',
+                  sa.Column('wall_time', sa.Float(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('testcaseresult', 'wall_time')
+    op.drop_column('testcaseresult', 'output_bytes')
+    op.drop_column('testcaseresult', 'max_rss')
+    op.drop_column('testcaseresult', 'cpu_user')
+    op.drop_column('testcaseresult', 'cpu_system')
@@ -0,0 +1,24 @@
+"""Add is_superseded to submission
+
+Revision ID: 6d2c8e4f1a7b
+Revises: 2e6f3a9b7c1d
+Create Date: 2026-10-17 14:02:48.311529
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d2c8e4f1a7b'
+down_revision = '2e6f3a9b7c1d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('submission', sa.Column('is_superseded', sa.Boolean(),
+                                          server_default=u'0',
+                                          nullable=False))
+
+
+def downgrade():
+    op.drop_column('submission', 'is_superseded')
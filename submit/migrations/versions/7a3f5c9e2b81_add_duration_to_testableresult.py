@@ -0,0 +1,23 @@
+"""Add duration to testableresult
+
+Revision ID: 7a3f5c9e2b81
+Revises: 4b9e1d7c3f26
+Create Date: 2026-10-17 16:08:12.557310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a3f5c9e2b81'
+down_revision = '4b9e1d7c3f26'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('testableresult', sa.Column('duration', sa.Float(),
+                                              nullable=True))
+
+
+def downgrade():
+    op.drop_column('testableresult', 'duration')
@@ -10,9 +10,9 @@ from datetime import datetime, timedelta
 from hashlib import sha1
 from pyramid_addons.helpers import UTC
 from sqla_mixins import BasicBase, UserMixin
-from sqlalchemy import (Binary, Boolean, Column, DateTime, Enum, ForeignKey,
-                        Integer, PickleType, String, Table, Unicode,
-                        UnicodeText, and_, func)
+from sqlalchemy import (Binary, Boolean, Column, DateTime, Enum, Float,
+                        ForeignKey, Integer, PickleType, String, Table,
+                        Unicode, UnicodeText, and_, cast, func)
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, relationship, scoped_session, sessionmaker
@@ -560,6 +560,81 @@ class Project(BasicBase, Base):
         return retval
 
 
+class RegradeCampaign(BasicBase, Base):
+    """Requeues a project's most recent submissions in the background.
+
+    The campaign worker queues at most `rate` of the pending submissions per
+    minute, and only while the live queues hold no more than
+    `idle_threshold` jobs, so that regrades yield to new submissions.
+
+    """
+    created_by = relationship('User')
+    created_by_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    idle_threshold = Column(Integer, nullable=False, default=0)
+    pending = Column(UnicodeText, nullable=False)  # JSON list of ids
+    project = relationship(Project, backref=backref(
+        'regrade_campaigns', cascade='all, delete-orphan',
+        order_by='RegradeCampaign.created_at.desc()'))
+    project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
+    queued = Column(Integer, nullable=False, default=0)
+    rate = Column(Float, nullable=False)  # Submissions per minute
+    running_time = Column(Float, nullable=False, default=0)  # In seconds
+    status = Column(Enum('done', 'paused', 'running',
+                         name='campaign_status'), nullable=False,
+                    default='running')
+    total = Column(Integer, nullable=False)
+
+    def can_edit(self, user):
+        """Return whether or not `user` can pause or resume the campaign."""
+        return self.project.can_edit(user)
+
+    @staticmethod
+    def create(project, user, rate, idle_threshold=0):
+        """Return a campaign for the project's most recent submissions.
+
+        Return None, without attaching a campaign to the project, when the
+        project has no submissions.
+
+        """
+        pending = [x.id for x in project.recent_submissions()]
+        if not pending:
+            return None
+        campaign = RegradeCampaign(
+            created_by=user, idle_threshold=idle_threshold,
+            pending=json.dumps(pending), project=project, queued=0,
+            rate=rate, running_time=0, status='running', total=len(pending))
+        Session.add(campaign)
+        return campaign
+
+    def eta(self):
+        """Return the estimated seconds until every submission is queued.
+
+        The estimate uses the rate observed so far, which accounts for the
+        time spent waiting for the live queues, and falls back to `rate`.
+
+        """
+        remaining = self.total - self.queued
+        if self.status == 'done' or not remaining:
+            return 0
+        if self.queued and self.running_time:
+            return remaining * self.running_time / self.queued
+        return remaining * 60. / self.rate
+
+    def pop(self, count):
+        """Remove and return up to count of the pending submission ids."""
+        pending = json.loads(self.pending)
+        retval, pending = pending[:count], pending[count:]
+        self.pending = json.dumps(pending)
+        self.queued += len(retval)
+        if not pending:
+            self.status = 'done'
+        return retval
+
+    def progress(self):
+        """Return the percentage of the submissions queued so far."""
+        return 100 * self.queued / self.total if self.total else 100
+
+
 class Submission(BasicBase, Base):
     created_by = relationship('User')
     created_by_id = Column(Integer, ForeignKey('user.id'), nullable=False)
@@ -567,6 +642,9 @@ class Submission(BasicBase, Base):
     group_id = Column(Integer, ForeignKey('group.id'), nullable=False)
     files = relationship('SubmissionToFile', backref='submission',
                          cascade='all, delete-orphan')
+    # Set when a later submission by the group made grading this one wait
+    is_superseded = Column(Boolean, default=False, nullable=False,
+                           server_default='0')
     project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
     test_case_results = relationship('TestCaseResult', backref='submission',
                                      cascade='all, delete-orphan')
@@ -688,6 +766,8 @@ class Submission(BasicBase, Base):
         fmt = '<a href="{url}">{created}</a>{name} {score} {modifier}'
         if not self.verification_results:
             score = '<span class="label">waiting to verify submission</span>'
+        elif self.testables_pending() and self.is_superseded:
+            score = '<span class="label">superseded</span>'
         elif self.testables_pending():
             score = '<span class="label">waiting for results</span>'
         elif not admin and self.get_delay(update=False):
@@ -758,6 +838,8 @@ class TestCase(BasicBase, Base):
     testable_id = Column(Integer, ForeignKey('testable.id'), nullable=False)
     test_case_for = relationship('TestCaseResult', backref='test_case',
                                  cascade='all, delete-orphan')
+    # Calibrated from the reference run when the project is updated
+    time_limit = Column(Float, nullable=True)
 
     def __cmp__(self, other):
         return cmp(alphanum_key(self.name), alphanum_key(other.name))
@@ -775,7 +857,8 @@ class TestCase(BasicBase, Base):
 
     def serialize(self):
         data = dict([(x, getattr(self, x)) for x in ('args', 'id', 'source',
-                                                     'output_filename')])
+                                                     'output_filename',
+                                                     'time_limit')])
         if self.stdin:
             data['stdin'] = self.stdin.sha1
         else:
@@ -792,14 +875,26 @@ class TestCaseResult(Base):
     When the TestCase output_type is not `diff` the diff file is actually
     the raw output file.
 
+    The resource usage fields (CPU and wall time in seconds, max_rss in KiB
+    and the size of the output in bytes) are NULL for results that were not
+    produced by running the test case. When the output limit was exceeded,
+    output_bytes is the limit, as the output's full size is unknown.
+
     """
     __tablename__ = 'testcaseresult'
+    USAGE_FIELDS = ('cpu_system', 'cpu_user', 'max_rss', 'output_bytes',
+                    'wall_time')
+    cpu_system = Column(Float, nullable=True)
+    cpu_user = Column(Float, nullable=True)
     diff = relationship(File, backref='test_case_result_for')
     diff_id = Column(Integer, ForeignKey('file.id'), nullable=True)
+    max_rss = Column(Integer, nullable=True)
+    output_bytes = Column(Integer, nullable=True)
     status = Column(Enum('nonexistent_executable', 'output_limit_exceeded',
                          'signal', 'success', 'timed_out',
                          name='status'), nullable=False)
     extra = Column(Integer)
+    wall_time = Column(Float, nullable=True)
     submission_id = Column(Integer, ForeignKey('submission.id'),
                            primary_key=True, nullable=False)
     test_case_id = Column(Integer, ForeignKey('testcase.id'),
@@ -810,6 +905,24 @@ class TestCaseResult(Base):
         return Session.query(cls).filter_by(
             submission_id=submission_id, test_case_id=test_case_id).first()
 
+    @classmethod
+    def resource_usage(cls, testable_ids):
+        """Return the aggregate resource usage of the testables' results."""
+        columns = [func.count(cls.wall_time)]
+        for field in cls.USAGE_FIELDS:
+            column = getattr(cls, field)
+            # PostgreSQL returns Decimals, which cannot be rendered as JSON
+            columns.extend([cast(func.avg(column), Float), func.max(column),
+                            cast(func.sum(column), Float)])
+        row = list(Session.query(*columns)
+                   .join(TestCase, TestCase.id == cls.test_case_id)
+                   .filter(TestCase.testable_id.in_(testable_ids)).one())
+        retval = {'runs': row.pop(0)}
+        for field in cls.USAGE_FIELDS:
+            retval[field] = dict(zip(('avg', 'max', 'total'), row[:3]))
+            del row[:3]
+        return retval
+
     def update(self, data):
         for attr, val in data.items():
             setattr(self, attr, val)
@@ -857,6 +970,41 @@ class Testable(BasicBase, Base):
                                sorted(self.test_cases)]}
         return json.dumps(data) if jsonify else data
 
+    def config_sha1(self):
+        """Return a sha1 of the configuration that determines the results.
+
+        Any change to the project's Makefile or to this testable's build
+        settings, files or test cases results in a different value.
+
+        """
+        makefile = self.project.makefile
+        config = {
+            'build_files': sorted((x.filename, x.file.sha1)
+                                  for x in self.build_files),
+            'executable': self.executable,
+            'execution_files': sorted((x.filename, x.file.sha1)
+                                      for x in self.execution_files),
+            'file_verifiers': sorted((x.filename, x.optional,
+                                      x.copy_to_execution)
+                                     for x in self.file_verifiers),
+            'make_target': self.make_target,
+            'makefile': makefile.sha1 if makefile else None,
+            'test_cases': [(x.serialize(),
+                            x.expected.sha1 if x.expected else None,
+                            x.output_type, x.points)
+                           for x in sorted(self.test_cases)]}
+        return sha1(json.dumps(config, sort_keys=True)).hexdigest()
+
+    def fingerprint(self, submission):
+        """Return a sha1 identifying the results of submission's files.
+
+        Submissions with the same fingerprint for a testable produce the same
+        results while the testable's configuration is unchanged.
+
+        """
+        files = sorted((x.filename, x.file.sha1) for x in submission.files)
+        return sha1(json.dumps([self.config_sha1(), files])).hexdigest()
+
     def points(self):
         return sum([test_case.points for test_case in self.test_cases])
 
@@ -881,6 +1029,8 @@ class Testable(BasicBase, Base):
 
 class TestableResult(BasicBase, Base):
     __table_args__ = (UniqueConstraint('submission_id', 'testable_id'),)
+    duration = Column(Float, nullable=True)  # Seconds the worker took
+    fingerprint = Column(String, nullable=True, index=True)
     make_results = Column(UnicodeText, nullable=True)
     points = Column(Integer, nullable=False)
     status = Column(Enum('make_failed', 'nonexistent_executable', 'success',
@@ -901,6 +1051,50 @@ class TestableResult(BasicBase, Base):
         tr.status = status
         return tr
 
+    @staticmethod
+    def fetch_reusable(submission, testable, fingerprint):
+        """Return an earlier result of testable with the same fingerprint."""
+        return (TestableResult
+                .query_by(testable=testable, fingerprint=fingerprint)
+                .filter(TestableResult.submission_id != submission.id)
+                .order_by(TestableResult.created_at.desc()).first())
+
+    @staticmethod
+    def median_duration(testable_id, samples=20):
+        """Return the median duration of testable's latest results or None.
+
+        Only the latest `samples` results with a recorded duration are
+        considered.
+
+        """
+        durations = sorted(x for (x,) in Session.query(
+            TestableResult.duration).filter(
+                TestableResult.testable_id == testable_id,
+                TestableResult.duration.isnot(None))
+            .order_by(TestableResult.created_at.desc()).limit(samples))
+        if not durations:
+            return None
+        middle = len(durations) // 2
+        if len(durations) % 2:
+            return durations[middle]
+        return (durations[middle - 1] + durations[middle]) / 2.
+
+    def clone_for(self, submission):
+        """Copy this result and its TestCaseResults to submission."""
+        for test_case in self.testable.test_cases:
+            tcr = TestCaseResult.fetch_by_ids(self.submission_id,
+                                              test_case.id)
+            if tcr:
+                Session.add(TestCaseResult(
+                    diff=tcr.diff, extra=tcr.extra, status=tcr.status,
+                    submission=submission, test_case=test_case))
+        result = TestableResult(
+            fingerprint=self.fingerprint, make_results=self.make_results,
+            points=self.points, status=self.status, submission=submission,
+            testable=self.testable)
+        Session.add(result)
+        return result
+
 
 class User(UserMixin, BasicBase, Base):
     """The UserMixin provides the `username` and `password` attributes.
@@ -177,6 +177,21 @@ $(function() {
             $.ajax({url: url, type: "delete", complete: handle_response});
         }
     });
+    $(".button-campaign").on("click", function(event) {
+        var status = event.target.getAttribute("data-status");
+        var url = event.target.getAttribute("data-url");
+        $.ajax({url: url, type: "post", complete: handle_response,
+                data: JSON.stringify({status: status}),
+                contentType: "application/json; charset=utf-8"});
+    });
+    $(".button-regrade").on("click", function(event) {
+        var name = event.target.getAttribute("data-name");
+        var url = event.target.getAttribute("data-url");
+        if (confirm("Are you sure you want to rerun " + name + " for all the latest submissions?")) {
+            $.ajax({url: url, type: "put", complete: handle_response});
+        }
+        return false;
+    });
     $(".toggle_tc_file").on("change", function(event) {
         var testable = event.target.getAttribute("data-testable");
         var tc = event.target.getAttribute("data-tc");
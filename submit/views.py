@@ -29,9 +29,9 @@ from .helpers import (
     project_file_create, project_file_delete, send_email,
     test_case_verification, zip_response)
 from .models import (BuildFile, Class, ExecutionFile, File, FileVerifier,
-                     Group, GroupRequest, PasswordReset, Project, Session,
-                     Submission, SubmissionToFile, TestCase, Testable, User,
-                     UserToGroup)
+                     Group, GroupRequest, PasswordReset, Project,
+                     RegradeCampaign, Session, Submission, SubmissionToFile,
+                     TestCase, TestCaseResult, Testable, User, UserToGroup)
 
 # Hack for old pickle files
 # TODO: Migrate this data to not use pickle
@@ -657,7 +657,8 @@ def project_info(request, project):
                 'source': test_case.source,
                 'stdin': stdin, 'expected': expected,
                 'output_type': test_case.output_type,
-                'output_filename': test_case.output_filename}
+                'output_filename': test_case.output_filename,
+                'time_limit': test_case.time_limit}
         retval['testables'][testable.name] = {'id': testable.id,
                                               'test_cases': test_cases}
     return retval
@@ -680,16 +681,29 @@ def project_new(request, class_):
              request_method='PUT', permission='authenticated')
 @validate(project=EditableDBThing('project_id', Project, source=MATCHDICT))
 def project_requeue(request, project):
-    count = 0
-    for count, submission in enumerate(project.recent_submissions(), start=1):
-        request.queue(submission_id=submission.id, _priority=2)
-    if count == 0:
+    settings = request.registry.settings
+    campaign = RegradeCampaign.create(
+        project, request.user, float(settings.get('regrade_rate', 30)),
+        int(settings.get('regrade_idle_threshold', 0)))
+    if campaign is None:
         return http_ok(request, message='There are no submissions to requeue.')
-    request.session.flash('Requeued the most recent submissions ({0} items).'
-                          .format(count), 'successes')
+    request.session.flash('Started regrading the most recent submissions '
+                          '({0} items).'.format(campaign.total), 'successes')
     return http_ok(request, redir_location=request.url)
 
 
+@view_config(route_name='project_resources', request_method='GET',
+             permission='authenticated', renderer='json')
+@validate(project=EditableDBThing('project_id', Project, source=MATCHDICT))
+def project_resources(request, project):
+    testables = {x.name: TestCaseResult.resource_usage([x.id])
+                 for x in project.testables}
+    total = TestCaseResult.resource_usage([x.id for x in project.testables]) \
+        if project.testables else None
+    return {'id': project.id, 'name': project.name, 'testables': testables,
+            'total': total}
+
+
 @view_config(route_name='project_scores', request_method='GET',
              permission='authenticated')
 @validate(project=EditableDBThing('project_id', Project, source=MATCHDICT))
@@ -887,6 +901,22 @@ def project_view_summary(request, project):
             'submissions': sorted(submissions.items())}
 
 
+@view_config(route_name='regrade_campaign_item', request_method='POST',
+             permission='authenticated', renderer='json')
+@validate(campaign=EditableDBThing('regrade_campaign_id', RegradeCampaign,
+                                   source=MATCHDICT),
+          status=Enum('status', 'paused', 'running'))
+def regrade_campaign_update(request, campaign, status):
+    if campaign.status == 'done':
+        raise HTTPConflict('The campaign has already finished.')
+    if not campaign.update(status=status):
+        return http_ok(request, message='Nothing to change')
+    request.session.flash('{0} the regrade campaign.'.format(
+        'Paused' if status == 'paused' else 'Resumed'), 'successes')
+    return http_ok(request, redir_location=request.route_path(
+        'project_edit', project_id=campaign.project.id))
+
+
 @view_config(route_name='session', request_method='PUT', renderer='json')
 @validate(username=Or('email', EmailAddress(''), String('')),
           password=WhiteSpaceString('password', min_length=6),
@@ -1133,6 +1163,26 @@ def test_case_delete(request, test_case):
     return http_ok(request, redir_location=redir_location)
 
 
+@view_config(route_name='test_case_item', request_method='PUT',
+             permission='authenticated', renderer='json')
+@validate(test_case=EditableDBThing('test_case_id', TestCase,
+                                    source=MATCHDICT))
+def test_case_regrade(request, test_case):
+    """Rerun only test_case for the most recent submission of each group."""
+    count = 0
+    for count, submission in enumerate(
+            test_case.testable.project.recent_submissions(), start=1):
+        request.queue(submission_id=submission.id,
+                      test_case_ids=[test_case.id], _priority=2)
+    if count == 0:
+        return http_ok(request, message='There are no submissions to regrade.')
+    request.session.flash('Regrading TestCase {0} of the most recent '
+                          'submissions ({1} items).'
+                          .format(test_case.name, count), 'successes')
+    return http_ok(request, redir_location=request.route_path(
+        'project_edit', project_id=test_case.testable.project.id))
+
+
 @view_config(route_name='test_case_item', request_method='POST',
              permission='authenticated', renderer='json')
 @validate(name=String('name', min_length=1),
@@ -1151,6 +1201,7 @@ def test_case_delete(request, test_case):
 def test_case_update(request, name, args, expected, hide_expected,
                      output_filename, output_source, output_type, points,
                      stdin, test_case):
+    stale = args != test_case.args or stdin != test_case.stdin
     if not test_case.update(name=name, args=args, expected=expected,
                             hide_expected=bool(hide_expected),
                             output_filename=output_filename,
@@ -1161,6 +1212,8 @@ def test_case_update(request, name, args, expected, hide_expected,
         Session.flush()
     except IntegrityError:
         raise HTTPConflict('That name already exists for the testable')
+    if stale:  # Recalibrated when the expected outputs are next generated
+        test_case.time_limit = None
     # Update the testable point score
     test_case.testable.update_points()
     request.session.flash('Updated TestCase {0}.'.format(test_case.name),
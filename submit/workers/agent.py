@@ -0,0 +1,68 @@
+import subprocess
+import time
+from .exceptions import AgentError
+from .worker import read_frame, write_frame
+
+
+class AgentConnection(object):
+
+    """A long-lived channel to the worker agent running on a single machine.
+
+    The agent is started lazily with `command` (e.g. an ssh command running
+    `python worker.py agent`) and is restarted whenever the channel breaks.
+    `command` may also be a callable returning the command to run.
+
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+
+    @property
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def ping(self):
+        """Return the round trip time of a ping through the agent."""
+        start = time.time()
+        self.request({'command': 'ping'})
+        return time.time() - start
+
+    def request(self, message, progress=None):
+        """Send message to the agent and return its reply.
+
+        Progress messages received before the reply are passed to `progress`
+        when provided.
+
+        """
+        if not self.is_alive:
+            self.close()
+            command = self.command() if callable(self.command) \
+                else self.command
+            self.process = subprocess.Popen(
+                command, shell=True, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, close_fds=True)
+        try:
+            write_frame(self.process.stdin, message)
+            while True:
+                reply = read_frame(self.process.stdout)
+                if reply is None:
+                    raise AgentError('Agent channel closed')
+                if reply['type'] != 'progress':
+                    return reply
+                if progress:
+                    progress(reply)
+        except (IOError, OSError, ValueError) as exc:
+            self.close()
+            raise AgentError('Agent channel failed: {0}'.format(exc))
+        except AgentError:
+            self.close()
+            raise
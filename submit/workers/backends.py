@@ -0,0 +1,297 @@
+import base64
+import json
+import os
+import pipes
+import pwd
+import resource
+import subprocess
+import sys
+import time
+from pyramid.settings import asbool
+from .agent import AgentConnection
+from .exceptions import SSHConnectTimeout
+from .ssh import SSHConnectionPool
+from .worker import unpack_results
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'worker.py')
+
+
+class ExecutionBackend(object):
+
+    """Interface between the WorkerProxy and the machines running the Worker.
+
+    The proxy prepares a bundle of jobs in a local directory. Each job
+    has its own subdirectory holding `data.json` along with either the `src`,
+    `inputs` and `execution_files` trees or, when `file_cache` is set, a
+    manifest of those files; the files missing from the machine's cache are
+    then sent once in the bundle's `blobs` directory. A backend transfers
+    the bundle to the machine and runs the Worker's batch mode there, which
+    streams back the jobs' results as a single compressed reply.
+
+    A backend may be shared by several threads provided they never use the
+    same machine at the same time.
+
+    """
+
+    file_cache = False
+
+    def close(self):
+        """Release any connections to the machines as the proxy shuts down."""
+
+    def missing_files(self, machine, sha1s):
+        """Return the set of sha1s not present in machine's file cache."""
+        raise NotImplementedError
+
+    def ping(self, machine):
+        """Return the round trip time to machine without disturbing it."""
+        raise NotImplementedError
+
+    def prepare(self, machine):
+        """Ready machine for a new job and return its latency if measured.
+
+        The Worker kills every process a job started once the job ends, so
+        no cleanup round trip is needed before a job.
+
+        """
+        raise NotImplementedError
+
+    def push(self, machine, path='.'):
+        """Replace the bundle on machine with the directory path."""
+        raise NotImplementedError
+
+    def run(self, machine):
+        """Run the Worker on machine against the pushed bundle.
+
+        Return a mapping of each job's name to a mapping of its results
+        files' names to their contents. Jobs that failed are omitted.
+
+        """
+        raise NotImplementedError
+
+
+class LocalBackend(ExecutionBackend):
+
+    """Run the Worker in a subprocess on the proxy host.
+
+    Each machine name is a slot directory under `root` that plays the role of
+    a worker account's home directory. When `user` is set every command runs
+    as that user via `sudo -n -u`, thus the proxy account must be allowed to
+    do so without a password. Files are streamed to and from the slot through
+    tar so that the user never needs access to the proxy's files. Without
+    `user` the submissions could read the proxy's keys and configuration,
+    thus backend_from_settings always requires a separate one.
+
+    The Worker runs with the `rlimits` resource limits and with TMPDIR set to
+    a private directory inside its slot that is emptied before each job.
+    Since the slots share one account, the Worker runs in `shared` mode and
+    leaves the account's other processes running.
+
+    """
+
+    RLIMITS = {resource.RLIMIT_CORE: 0,
+               resource.RLIMIT_NOFILE: 1024,
+               resource.RLIMIT_NPROC: 512}
+
+    def __init__(self, root, user=None, rlimits=None, python=None):
+        self.root = root
+        self.user = user
+        self.rlimits = self.RLIMITS if rlimits is None else rlimits
+        self.python = python or sys.executable
+
+    def _call(self, script, output=False, **kwargs):
+        """Run the shell script as the worker user.
+
+        Return the script's output when `output` is set.
+
+        """
+        cmd = 'sh -c {0}'.format(pipes.quote(script))
+        if self.user:
+            cmd = 'sudo -n -u {0} {1}'.format(pipes.quote(self.user), cmd)
+        if output:
+            return subprocess.check_output(cmd, shell=True, **kwargs)
+        subprocess.check_call(cmd, shell=True, **kwargs)
+
+    def _limit(self):
+        for limit, value in self.rlimits.items():
+            resource.setrlimit(limit, (value, value))
+
+    def _worker(self, machine, args=''):
+        return 'cd {slot} && exec {python} {script} {args}'.format(
+            slot=pipes.quote(self.slot(machine)),
+            python=pipes.quote(self.python),
+            script=pipes.quote(WORKER_SCRIPT), args=args)
+
+    def missing_files(self, machine, sha1s):
+        return set(sha1s)
+
+    def ping(self, machine):
+        return 0.
+
+    def prepare(self, machine):
+        return None
+
+    def push(self, machine, path='.'):
+        tar = subprocess.Popen('tar -chf - .', shell=True,
+                               stdout=subprocess.PIPE, cwd=path)
+        try:
+            self._call('mkdir -p {slot} && cd {slot} && rm -rf working tmp '
+                       '&& mkdir working && mkdir -m 700 tmp '
+                       '&& tar -xf - -C working'
+                       .format(slot=pipes.quote(self.slot(machine))),
+                       stdin=tar.stdout)
+        finally:
+            tar.stdout.close()
+            status = tar.wait()
+        if status != 0:
+            raise subprocess.CalledProcessError(status, 'tar -c')
+
+    def run(self, machine):
+        tmp = os.path.join(self.slot(machine), 'tmp')
+        return unpack_results(self._call(
+            'TMPDIR={0} && export TMPDIR && {1}'.format(
+                pipes.quote(tmp), self._worker(machine, 'batch shared')),
+            output=True, preexec_fn=self._limit))
+
+    def slot(self, machine):
+        return os.path.join(self.root, machine)
+
+
+class RemoteBackend(ExecutionBackend):
+
+    """Run the Worker on remote machines over ssh and rsync.
+
+    Each machine's worker account must contain a copy of `worker.py` in its
+    home directory. With `use_agent` the Worker is driven through a
+    long-lived agent rather than one ssh session per step, and with
+    `file_cache` only the files a machine lacks are transferred.
+
+    """
+
+    def __init__(self, account, private_key_file, multiplex=False,
+                 use_agent=False, file_cache=False):
+        self.account = account
+        self.ssh_pool = SSHConnectionPool(account, private_key_file,
+                                          multiplex=multiplex)
+        self.use_agent = use_agent
+        self.file_cache = file_cache
+        self.agents = {}
+
+    def agent(self, machine):
+        """Return the (lazily started) agent connection for machine."""
+        if machine not in self.agents:
+            command = 'python worker.py agent'
+            self.agents[machine] = AgentConnection(
+                lambda: self.ssh_pool.command(machine, command, timeout=1))
+        return self.agents[machine]
+
+    def close(self):
+        for agent in self.agents.values():
+            agent.close()
+        self.ssh_pool.close()
+
+    def missing_files(self, machine, sha1s):
+        if self.use_agent:
+            reply = self.agent(machine).request({'command': 'missing',
+                                                 'sha1s': sorted(sha1s)})
+            return set(reply['missing'])
+        output = self.ssh(machine, 'python worker.py missing {0}'
+                          .format(' '.join(sorted(sha1s))))
+        return set(json.loads(output))
+
+    def ping(self, machine):
+        if self.use_agent:
+            return self.agent(machine).ping()
+        start = time.time()
+        self.ssh(machine, 'true', timeout=1)
+        return time.time() - start
+
+    def prepare(self, machine):
+        if self.use_agent:  # Restart the agent now if its channel broke
+            return self.agent(machine).ping()
+        elif self.ssh_pool.multiplex:
+            start = time.time()
+            self.ssh_pool.connect(machine, timeout=1)
+            return time.time() - start
+        return None  # The push detects unreachable machines
+
+    def push(self, machine, path='.'):
+        local = os.path.join(path, '')  # Sync the directory's contents
+        if self.file_cache:
+            self.rsync(machine, from_local=True, remote='incoming/',
+                       local=local)
+        else:
+            self.rsync(machine, from_local=True, local=local)
+
+    def rsync(self, machine, from_local=False, remote='working/', local='.'):
+        """Synchronize local with remote on machine."""
+        src = '{}@{}:{}'.format(self.account, machine, remote)
+        dst = local
+        if from_local:
+            src, dst = dst, src
+        cmd = ('rsync -e \'{}\' --timeout=16 --delete -rLpv {} {}'
+               .format(self.ssh_pool.rsync_shell(machine, timeout=1), src,
+                       dst))
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(cmd, shell=True, stdout=devnull,
+                                    stderr=subprocess.PIPE)
+            stderr = proc.communicate()[1]
+        if proc.returncode != 0:
+            if 'Connection timed out' in stderr:
+                raise SSHConnectTimeout()
+            raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                                output=stderr)
+
+    def run(self, machine):
+        if not self.use_agent:
+            return unpack_results(self.ssh(
+                machine, 'python worker.py batch cached'
+                if self.file_cache else 'python worker.py batch'))
+        message = {'command': 'batch', 'path': 'working'}
+        if self.file_cache:
+            message['incoming'] = 'incoming'
+        reply = self.agent(machine).request(message)
+        if reply['status'] != 'success':
+            raise Exception('Worker failed on {0}:\n{1}'
+                            .format(machine, reply.get('error')))
+        return unpack_results(base64.b64decode(reply['results']))
+
+    def ssh(self, machine, command, timeout=None):
+        cmd = self.ssh_pool.command(machine, command, timeout=timeout)
+        proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            if proc.returncode == 255:  # Recheck the connection before reuse
+                self.ssh_pool.invalidate(machine)
+            if stderr.strip().endswith('Connection timed out'):
+                raise SSHConnectTimeout()
+            output = stdout + '\n' + stderr if stdout else stderr
+            raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                                output=output)
+        return stdout
+
+
+def backend_from_settings(settings, account):
+    """Return the ExecutionBackend configured by `worker_backend`.
+
+    The `local` backend refuses to start unless `worker_local_user` names a
+    user other than the proxy's own.
+
+    """
+    kind = settings.get('worker_backend', 'remote')
+    if kind == 'local':
+        user = settings.get('worker_local_user', '').format(account)
+        if not user or user == pwd.getpwuid(os.getuid()).pw_name:
+            raise Exception('worker_local_user must be a user other than the '
+                            'proxy\'s own: {0!r}'.format(user))
+        return LocalBackend(settings['worker_local_root'].format(account),
+                            user=user)
+    elif kind == 'remote':
+        return RemoteBackend(
+            account, settings['ssh_priv_key'],
+            multiplex=asbool(settings.get('ssh_multiplex', False)),
+            use_agent=asbool(settings.get('worker_agent', False)),
+            file_cache=asbool(settings.get('worker_file_cache', False)))
+    raise Exception('Invalid worker_backend: {0}'.format(kind))
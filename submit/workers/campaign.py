@@ -0,0 +1,89 @@
+import argparse
+import time
+import transaction
+from pyramid.paster import get_appsettings
+from pyramid.settings import aslist
+from sqlalchemy import engine_from_config
+from .queue import JobQueue
+from .. import workers
+from ..models import RegradeCampaign, configure_sql
+
+
+class CampaignRunner(object):
+
+    """Queue the submissions of running regrade campaigns when idle.
+
+    Every `regrade_interval` seconds each running campaign earns `rate / 60`
+    submissions per elapsed second, up to one interval's worth, and spends
+    them only while the verification queue and every tell_worker queue but
+    the lowest priority one hold at most the campaign's `idle_threshold`
+    jobs. The submissions are then verified and graded at low priority.
+
+    """
+
+    def __init__(self, settings):
+        self.interval = float(settings.get('regrade_interval', 10))
+        tell_worker = settings['queue_tell_worker']
+        if isinstance(tell_worker, basestring):
+            tell_worker = [tell_worker]
+        self.verification_queue = settings['queue_verification']
+        self.queue = JobQueue(settings['queue_server'],
+                              [self.verification_queue] + tell_worker[:-1])
+        self.credits = {}  # Mapping of campaign ids to submissions allowed
+        self.checked_at = time.time()
+
+    def check(self):
+        """Queue the submissions the running campaigns may queue now."""
+        now = time.time()
+        elapsed, self.checked_at = now - self.checked_at, now
+        depth = self.queue.depth()
+        submission_ids = []
+        try:
+            for campaign in RegradeCampaign.query_by(status='running'):
+                campaign.running_time += elapsed
+                credit = min(max(1, campaign.rate * self.interval / 60),
+                             self.credits.get(campaign.id, 0) +
+                             campaign.rate * elapsed / 60)
+                if depth > campaign.idle_threshold:
+                    self.credits[campaign.id] = 0
+                    continue
+                ids = campaign.pop(int(credit))
+                self.credits[campaign.id] = credit - len(ids)
+                if ids:
+                    workers.log_msg('Campaign {0}: queued {1} ({2}/{3})'
+                                    .format(campaign.id, len(ids),
+                                            campaign.queued, campaign.total))
+                submission_ids.extend(ids)
+                depth += len(ids)
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            raise
+        for submission_id in submission_ids:
+            self.queue.publish({'submission_id': submission_id,
+                                '_priority': 2, 'queued_at': time.time()},
+                               self.verification_queue)
+
+    def serve(self):
+        """Check the campaigns every interval seconds until interrupted."""
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Queue the submissions of running regrade campaigns.')
+    parser.add_argument('ini_file', help='the configuration file to use')
+    args = parser.parse_args()
+    settings = dict(get_appsettings(args.ini_file, 'main'))
+    for key, value in settings.items():  # Split multi-line settings
+        if '\n' in value.strip():
+            settings[key] = aslist(value)
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    configure_sql(engine)
+    try:
+        CampaignRunner(settings).serve()
+    except KeyboardInterrupt:
+        pass
@@ -1,3 +1,8 @@
+class AgentError(Exception):
+
+    """Indicate that the channel to a worker agent failed."""
+
+
 class HandledError(Exception):
 
     """Indicate that the system state is invalid."""
@@ -8,6 +13,11 @@ class OutOfSync(Exception):
     """Indicate the worker is out of sync."""
 
 
+class Superseded(Exception):
+
+    """Indicate that a later submission by the same group is being graded."""
+
+
 class SSHConnectTimeout(Exception):
 
     """Indicate that the SSH session timed out while creating a connection."""
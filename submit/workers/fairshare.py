@@ -0,0 +1,192 @@
+import Queue
+import threading
+import time
+from collections import defaultdict
+
+
+def job_key(item):
+    """Return the (class id, group id) of a (delivery_tag, job) tuple."""
+    return item[1].get('class_id'), item[1].get('group_id')
+
+
+class FairShareQueue(object):
+
+    """Hand out jobs by weighted fair queueing across classes and groups.
+
+    Jobs are keyed by their class and then by their group. Each class has a
+    virtual time that advances by cost / weight for every job it is given,
+    and the waiting class whose next job would finish earliest in virtual
+    time, i.e., with the least virtual time + cost / weight, goes next. The
+    groups of a class share it in the same way with equal weights. A class or
+    group that starts waiting again begins at the current virtual time, so
+    idle ones cannot bank credit and busy ones cannot starve the others.
+    Groups with `group_cap` jobs in flight are passed over until `release`
+    is called for one of them.
+
+    `cost` is a function returning an item's expected duration, by default
+    1 for every item. A group's items are handed out shortest expected
+    first, where an item's expected duration is reduced by `aging` for
+    every second it has waited so that long jobs are not starved. As the
+    finish times include the cost, a long job also waits while the shorter
+    jobs of other groups and classes go ahead, until their virtual times
+    catch up. With equal costs the items are handed out in the order they
+    were put, as ties go to the earliest one.
+
+    The get, get_nowait and put methods mirror Queue.Queue's, thus it can
+    stand in for the pool's queue of pending jobs.
+
+    """
+
+    def __init__(self, class_weights=None, group_cap=None, key=job_key,
+                 cost=None, aging=1.):
+        self.class_weights = class_weights or {}
+        self.group_cap = group_cap
+        self.key = key
+        self.cost = cost or (lambda item: 1.)
+        self.aging = aging
+        self.classes = {}  # Classes' groups' (sequence, time, item) lists
+        self.vtime = {}  # Mapping of classes and (class, group) keys
+        self.class_now = {}  # Classes' latest finish times, their clocks
+        self.now = 0.
+        self.sequence = 0  # The number of items ever put
+        self.in_flight = defaultdict(int)  # Mapping of (class, group) keys
+        self.dispatched = defaultdict(int)  # Mapping of classes
+        self.lock = threading.Condition()
+
+    def _choose(self):
+        """Return the (class, group) key and index of the next job, or None.
+
+        Within each class the group whose head item would finish first (in
+        the class's virtual time) is chosen, and then the class whose chosen
+        item would finish first. Ties go to the item that was put first.
+
+        """
+        now = time.time()
+        best = None
+        for class_, groups in self.classes.items():
+            choice = None
+            for group, items in groups.items():
+                if self.group_cap and \
+                        self.in_flight[(class_, group)] >= self.group_cap:
+                    continue
+                scores = [self.cost(x) - self.aging * (now - y)
+                          for _, y, x in items]
+                index = scores.index(min(scores))
+                sequence, _, item = items[index]
+                cost = self.cost(item)
+                finish = self.vtime[(class_, group)] + cost, sequence
+                if choice is None or finish < choice[0]:
+                    choice = finish, cost, group, index
+            if choice is None:
+                continue
+            finish = (self.vtime[class_] + choice[1] / self.weight(class_),
+                      choice[0][1])
+            if best is None or finish < best[0]:
+                best = finish, (class_, choice[2]), choice[3]
+        return best and best[1:]
+
+    def _prune(self):
+        """Forget the virtual times of the drained classes and groups.
+
+        Only those that have fallen behind are forgotten, as they would
+        restart from the current virtual time anyway. A class's groups are
+        forgotten along with it.
+
+        """
+        dropped = set()
+        for class_ in [x for x in self.class_now if x not in self.classes
+                       and self.vtime[x] <= self.now]:
+            del self.vtime[class_]
+            del self.class_now[class_]
+            dropped.add(class_)
+        for key in [x for x in self.vtime if isinstance(x, tuple)]:
+            class_, group = key
+            if class_ in dropped or \
+                    group not in self.classes.get(class_, ()) and \
+                    self.vtime[key] <= self.class_now[class_]:
+                del self.vtime[key]
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the next item, counting its group in flight."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while True:
+                choice = self._choose()
+                if choice:
+                    break
+                remaining = None if deadline is None \
+                    else deadline - time.time()
+                if not block or remaining is not None and remaining <= 0:
+                    raise Queue.Empty
+                self.lock.wait(remaining)
+            key, index = choice
+            class_, group = key
+            groups = self.classes[class_]
+            _, _, item = groups[group].pop(index)
+            cost = self.cost(item)
+            if not groups[group]:
+                del groups[group]
+            if not groups:
+                del self.classes[class_]
+            self.now = self.vtime[class_]
+            self.vtime[class_] += cost / self.weight(class_)
+            self.vtime[key] += cost
+            self.class_now[class_] = self.vtime[key]
+            self.in_flight[key] += 1
+            self.dispatched[class_] += 1
+            self._prune()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put(self, item):
+        with self.lock:
+            class_, group = key = self.key(item)
+            if class_ not in self.classes:
+                self.classes[class_] = {}
+                self.vtime[class_] = max(self.vtime.get(class_, 0), self.now)
+            groups = self.classes[class_]
+            if group not in groups:
+                groups[group] = []
+                self.vtime[key] = max(self.vtime.get(key, 0),
+                                      self.class_now.get(class_, 0))
+            groups[group].append((self.sequence, time.time(), item))
+            self.sequence += 1
+            self.lock.notify_all()
+
+    def release(self, item):
+        """Record that an item returned by get is no longer in flight."""
+        with self.lock:
+            key = self.key(item)
+            self.in_flight[key] -= 1
+            if not self.in_flight[key]:
+                del self.in_flight[key]
+            self.lock.notify_all()
+
+    def shares(self, reset=False):
+        """Return a mapping of each known class to its current statistics.
+
+        `share` is the class's fraction of the jobs handed out since the
+        counts were last reset.
+
+        """
+        with self.lock:
+            total = sum(self.dispatched.values())
+            classes = set(self.classes) | set(self.dispatched) | \
+                set(x[0] for x in self.in_flight)
+            retval = {x: {
+                'dispatched': self.dispatched.get(x, 0),
+                'in_flight': sum(y for (z, _), y in self.in_flight.items()
+                                 if z == x),
+                'pending': sum(len(y) for y
+                               in self.classes.get(x, {}).values()),
+                'share': float(self.dispatched.get(x, 0)) / total
+                if total else 0.,
+                'weight': self.weight(x)} for x in classes}
+            if reset:
+                self.dispatched.clear()
+            return retval
+
+    def weight(self, class_):
+        return float(self.class_weights.get(class_, 1))
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Registry(object):
+
+    """Phase latency histograms and counters for the grading pipeline.
+
+    Each phase (e.g., push or run) has a latency histogram labelled by the
+    machine and project involved, when known. The registry is rendered in the
+    Prometheus text format and periodically written to `path`, from where it
+    can be exported through node_exporter's textfile collector.
+
+    """
+
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120,
+               300, 600)
+
+    def __init__(self, prefix='submit_worker', path=None, interval=15):
+        self.prefix = prefix
+        self.path = path
+        self.interval = interval
+        self.counters = defaultdict(float)  # (name, labels) to value
+        self.histograms = {}  # labels to [bucket counts, count, sum]
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((x, str(y)) for x, y in labels.items()
+                            if y is not None))
+
+    @staticmethod
+    def _format(labels, extra=()):
+        items = labels + tuple(extra)
+        if not items:
+            return ''
+        return '{{{0}}}'.format(','.join(
+            '{0}="{1}"'.format(x, y.replace('\\', '\\\\').replace('"', '\\"'))
+            for x, y in items))
+
+    def increment(self, name, amount=1, **labels):
+        """Add amount to the counter `name` with labels."""
+        with self.lock:
+            self.counters[(name, self._labels(labels))] += amount
+
+    def observe(self, phase, seconds, **labels):
+        """Record that phase took the given number of seconds."""
+        key = self._labels(dict(labels, phase=phase))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.BUCKETS), 0, 0.]
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        name = '{0}_phase_seconds'.format(self.prefix)
+        lines = ['# TYPE {0} histogram'.format(name)]
+        with self.lock:
+            for labels, (buckets, count, total) in sorted(
+                    self.histograms.items()):
+                for bound, value in zip(self.BUCKETS, buckets):
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, self._format(labels, [('le', str(bound))]),
+                        value))
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, self._format(labels, [('le', '+Inf')]), count))
+                lines.append('{0}_count{1} {2}'.format(
+                    name, self._format(labels), count))
+                lines.append('{0}_sum{1} {2}'.format(
+                    name, self._format(labels), total))
+            typed = set()
+            for (counter, labels), value in sorted(self.counters.items()):
+                counter = '{0}_{1}_total'.format(self.prefix, counter)
+                if counter not in typed:
+                    lines.append('# TYPE {0} counter'.format(counter))
+                    typed.add(counter)
+                lines.append('{0}{1} {2}'.format(
+                    counter, self._format(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Forget every observation and counter."""
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def start(self):
+        """Write the metrics every `interval` seconds in a background thread.
+
+        Nothing is done when no path is configured or the thread already
+        runs.
+
+        """
+        if not self.path or self._thread:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.interval)
+                self.write()
+        self._thread = threading.Thread(target=run, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def totals(self):
+        """Return a mapping of each phase to its (count, total seconds)."""
+        totals = defaultdict(lambda: [0, 0.])
+        with self.lock:
+            for labels, (_, count, total) in self.histograms.items():
+                phase = dict(labels)['phase']
+                totals[phase][0] += count
+                totals[phase][1] += total
+        return {x: tuple(y) for x, y in totals.items()}
+
+    @contextmanager
+    def timer(self, phase, **labels):
+        """Observe the time taken by the with statement's body."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.time() - start, **labels)
+
+    def write(self):
+        """Atomically replace the file at path with the current metrics."""
+        if not self.path:
+            return
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            fp.write(self.render())
+        os.rename(tmp_path, self.path)
+
+
+REGISTRY = Registry()
@@ -0,0 +1,218 @@
+import Queue
+import argparse
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import transaction
+from multiprocessing.pool import ThreadPool
+from pyramid.paster import get_appsettings
+from pyramid.settings import asbool, aslist
+from sqlalchemy import engine_from_config
+from .exceptions import HandledError, Superseded
+from .fairshare import FairShareQueue
+from .metrics import REGISTRY as metrics
+from .proxy import WorkerProxy
+from .queue import JobQueue
+from .runtime import RuntimeEstimator
+from .. import workers
+from ..models import configure_sql
+
+
+def in_transaction(func, *args):
+    """Call func within its own transaction and return its result."""
+    try:
+        retval = func(*args)
+        transaction.commit()
+    except Exception:
+        transaction.abort()
+        raise
+    return retval
+
+
+class WorkerPool(object):
+
+    """Drive every machine of several worker accounts from a single process.
+
+    Each (account, machine) pair is a slot that runs one bundle of jobs at a
+    time. One thread per slot pushes bundles and waits on the remote Worker,
+    while the database work is handed to a small pool of
+    `worker_pool_db_threads` threads, each with its own thread-local session.
+    Only the main thread talks to the message queues: it keeps every slot fed
+    and acknowledges jobs as the slots finish them.
+
+    Pending jobs are handed to the slots by a FairShareQueue, which shares
+    the machines between classes according to `worker_class_weights` and
+    limits each group to `worker_group_in_flight` running jobs. So that it
+    has jobs to choose from, up to `worker_pool_backlog` jobs beyond what
+    the slots can run are taken from the queues. With
+    `worker_pool_shortest_first` jobs are run shortest expected first, as
+    estimated from their testable's recent durations, both within and across
+    groups, and the shares are measured in expected seconds rather than jobs.
+
+    """
+
+    def __init__(self, settings, accounts):
+        self.proxies = [WorkerProxy(settings, x, slots=1) for x in accounts]
+        self.db = ThreadPool(int(settings.get('worker_pool_db_threads', 4)))
+        self.queue = JobQueue(settings['queue_server'],
+                              settings['queue_tell_worker'],
+                              settings.get('queue_tell_worker_error'))
+        self.report_interval = float(settings.get(
+            'worker_pool_report_interval', 60))
+        self.estimator = None
+        if asbool(settings.get('worker_pool_shortest_first', False)):
+            self.estimator = RuntimeEstimator()
+        weights = settings.get('worker_class_weights') or []
+        if isinstance(weights, basestring):
+            weights = weights.split()
+        self.pending = FairShareQueue(  # (delivery_tag, job) tuples to run
+            {int(x): float(y) for x, y in (z.split('=', 1) for z in weights)},
+            int(settings.get('worker_group_in_flight', 0)) or None,
+            cost=self.estimator,
+            aging=float(settings.get('worker_pool_aging', 1)))
+        self.done = Queue.Queue()  # (delivery_tag, job, error) tuples
+        self.in_flight = 0
+        self.capacity = sum(len(x.scheduler.machines) * x.batch_size
+                            for x in self.proxies)
+        self.backlog = int(settings.get('worker_pool_backlog',
+                                        self.capacity))
+
+    def finish(self, delivery_tag, job, error):
+        """Acknowledge the job, forwarding it to the error queue on error.
+
+        Jobs of superseded submissions are deferred or dropped instead.
+
+        """
+        if isinstance(error, Superseded):
+            self.queue.requeue_superseded(job)
+        elif error:
+            workers.log_msg('{0}.{1} failed: {2!r}'.format(
+                job['submission_id'], job['testable_id'], error))
+            self.queue.publish_error(job)
+        self.queue.ack(delivery_tag)
+        self.in_flight -= 1
+
+    def report(self):
+        """Log the utilisation of every slot and the classes' shares."""
+        for proxy in self.proxies:
+            for machine, stats in sorted(proxy.scheduler.report().items()):
+                workers.log_msg(
+                    'slot {0}@{1}: {2:.0%} utilised, {3} in flight ({4})'
+                    .format(proxy.account, machine, stats['utilisation'],
+                            stats['in_flight'], stats['state']))
+        for class_id, stats in sorted(self.pending.shares(reset=True)
+                                      .items()):
+            workers.log_msg(
+                'class {0}: {1:.0%} of jobs (weight {2}), {3} in flight, '
+                '{4} pending'.format(class_id, stats['share'],
+                                     stats['weight'], stats['in_flight'],
+                                     stats['pending']))
+
+    def run_batch(self, proxy, jobs):
+        """Run the jobs on one of proxy's machines and store their results.
+
+        Return the list of the jobs' errors as `WorkerProxy.do_batch` does.
+
+        """
+        errors, bundle, pending = self.db.apply(
+            in_transaction, (proxy.prepare_jobs, jobs))
+        if not bundle:
+            return errors
+        root = tempfile.mkdtemp()
+        try:
+            machine, results = proxy.run_shards(bundle, root)
+        finally:
+            shutil.rmtree(root)
+        return self.db.apply(proxy.store_bundle, (
+            jobs, bundle, pending, errors, machine, results))
+
+    def run_slot(self, proxy):
+        """Repeatedly run the next pending jobs on one of proxy's slots."""
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < proxy.batch_size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                errors = self.run_batch(proxy, [x[1] for x in batch])
+            except Exception as exc:
+                if not isinstance(exc, HandledError):
+                    workers.log_msg(traceback.format_exc())
+                errors = [exc] * len(batch)
+            for (delivery_tag, job), error in zip(batch, errors):
+                self.pending.release((delivery_tag, job))
+                metrics.increment('dispatched', class_id=job.get('class_id'))
+                self.done.put((delivery_tag, job, error))
+
+    def serve(self):
+        """Run jobs from the queues until interrupted."""
+        self.start()
+        reported_at = time.time()
+        while True:
+            if self.in_flight < self.capacity + self.backlog:
+                batch = self.queue.get_batch(
+                    self.capacity + self.backlog - self.in_flight, 0)
+                if batch and self.estimator:
+                    self.db.apply(in_transaction, (self.estimator.refresh,
+                                                   [x[1] for x in batch]))
+                for job in batch:
+                    self.pending.put(job)
+                    self.in_flight += 1
+            try:  # Wait briefly for a slot to finish when there is no work
+                self.finish(*self.done.get(timeout=0.5))
+                while True:
+                    self.finish(*self.done.get_nowait())
+            except Queue.Empty:
+                pass
+            if time.time() - reported_at >= self.report_interval:
+                self.report()
+                reported_at = time.time()
+
+    def start(self):
+        """Start the slots' threads and the machines' health probes.
+
+        The slots then run the (delivery_tag, job) tuples put on `pending`
+        and put a (delivery_tag, job, error) tuple on `done` for each.
+
+        """
+        for proxy in self.proxies:
+            proxy.scheduler.start(proxy.probe_interval)
+            for machine in sorted(proxy.scheduler.machines):
+                thread = threading.Thread(
+                    target=self.run_slot, args=(proxy,),
+                    name='slot-{0}@{1}'.format(proxy.account, machine))
+                thread.daemon = True
+                thread.start()
+        workers.log_msg('pool started with {0} slots'.format(sum(
+            len(x.scheduler.machines) for x in self.proxies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run jobs on the machines of several worker accounts.')
+    parser.add_argument('ini_file', help='the configuration file to use')
+    parser.add_argument('worker_accounts', nargs='+', metavar='worker_account')
+    args = parser.parse_args()
+    settings = dict(get_appsettings(args.ini_file, 'main'))
+    for key, value in settings.items():  # Split multi-line settings
+        if '\n' in value.strip():
+            settings[key] = aslist(value)
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    configure_sql(engine)
+    metrics.path = settings.get('worker_metrics_file', '').format('pool') \
+        or None
+    workers.SUPERSEDED = settings.get('superseded_submissions', 'defer')
+    pool = WorkerPool(settings, args.worker_accounts)
+    metrics.start()
+    try:
+        pool.serve()
+    except KeyboardInterrupt:
+        pool.report()
+    finally:
+        for proxy in pool.proxies:
+            proxy.backend.close()
@@ -1,35 +1,64 @@
 import amqp_worker
+import atexit
 import json
 import os
 import pickle
 import random
-import subprocess
+import shutil
+import tempfile
+import threading
 import time
-from heapq import heappop, heappush
+import traceback
+import transaction
+from pyramid.settings import asbool
 from sqlalchemy import engine_from_config
-from .exceptions import HandledError, SSHConnectTimeout
+from .backends import backend_from_settings
+from .exceptions import (AgentError, HandledError, SSHConnectTimeout,
+                         Superseded)
+from .metrics import REGISTRY as metrics
+from .queue import JobQueue
+from .scheduler import MachineScheduler
+from .verification import is_superseded
 from .. import workers
 from ..diff_unit import Diff
 from ..models import (File, Session, Submission, TestCaseResult, Testable,
                       TestableResult, configure_sql)
 
 
-def set_expected_files(testable, results, base_file_path):
-    # Update the expected output of each test case
+def set_expected_files(testable, results, base_file_path, limits=None,
+                       outputs=None):
+    """Update the expected output of each test case from the job's outputs.
+
+    `outputs` maps the job's output files (e.g., tc_1) to their contents.
+
+    When `limits` is a (multiplier, floor, ceiling) tuple, each test case's
+    time limit is calibrated as a multiple of its reference run's wall time.
+
+    """
     for test_case in testable.test_cases:
         if test_case.id not in results:
             raise Exception('Missing test case result in project update: {0}'
                             .format(test_case.id))
+        if limits:
+            result = results[test_case.id]
+            if result['status'] != 'timed_out' and result.get('wall_time'):
+                multiplier, floor, ceiling = limits
+                test_case.time_limit = min(ceiling, max(
+                    floor, result['wall_time'] * multiplier))
+            else:  # Fall back to the worker's default limit
+                test_case.time_limit = None
         if test_case.output_type == 'diff':
-            output_file = 'tc_{0}'.format(test_case.id)
-            test_case.expected = File.fetch_or_create(
-                open(output_file).read(), base_file_path)
+            output = (outputs or {}).get('tc_{0}'.format(test_case.id))
+            if output is None:
+                raise Exception('Missing test case output in project update: '
+                                '{0}'.format(test_case.id))
+            test_case.expected = File.fetch_or_create(output, base_file_path)
     testable.is_locked = False
     if not any(x.is_locked for x in testable.project.testables):
         testable.project.status = u'notready'
 
 
-def compute_diff(test_case, test_case_result, output_file, base_file_path):
+def compute_diff(test_case, test_case_result, actual_output, base_file_path):
     """Associate the diff (if exists) with the TestCaseResult.
 
     Return whether or not the outputs match.
@@ -37,10 +66,6 @@ def compute_diff(test_case, test_case_result, output_file, base_file_path):
     """
     with open(File.file_path(base_file_path, test_case.expected.sha1)) as fp:
         expected_output = fp.read()
-    actual_output = ''
-    if os.path.isfile(output_file):
-        with open('tc_{0}'.format(test_case.id)) as fp:
-            actual_output = fp.read()
     unit = Diff(expected_output, actual_output)
     if not unit.outputs_match():
         test_case_result.diff = File.fetch_or_create(pickle.dumps(unit),
@@ -49,104 +74,457 @@ def compute_diff(test_case, test_case_result, output_file, base_file_path):
     return True
 
 
-class WorkerProxy():
-    def __init__(self):
-        parser = amqp_worker.base_argument_parser()
-        parser.add_argument('worker_account', type=str)
-        args, settings = amqp_worker.parse_base_args(parser, 'app:main')
+def merge_results(shards):
+    """Return the results of a job whose test cases ran in several shards.
+
+    `shards` lists each shard's mapping of result file names to contents.
+    The test case results and outputs are combined, while the shards'
+    build results are summarised as if a single build took place. Return
+    None when any shard failed to produce results.
 
+    """
+    if any('testable' not in x for x in shards):
+        return None
+    retval = {}
+    test_cases = {}
+    testable = None
+    times = {}  # The shards ran concurrently
+    compiler_cache = {}
+    for shard in shards:
+        retval.update(shard)
+        test_cases.update(json.loads(shard.get('test_cases', '{}')))
+        data = json.loads(shard['testable'])
+        if testable is None or (testable['status'] == 'success' and
+                                data['status'] != 'success'):
+            testable = data
+        for name in ('duration', 'make_time'):
+            if name in data:
+                times[name] = max(times.get(name, 0), data[name])
+        for name, count in data.get('compiler_cache', {}).items():
+            compiler_cache[name] = compiler_cache.get(name, 0) + count
+    testable.update(times)
+    if compiler_cache:
+        testable['compiler_cache'] = compiler_cache
+    if testable['status'] == 'success':
+        retval['test_cases'] = json.dumps(test_cases)
+    else:
+        retval.pop('test_cases', None)
+    retval['testable'] = json.dumps(testable)
+    return retval
+
+
+class WorkerProxy():
+    def __init__(self, settings, account, slots=None):
         self.base_file_path = settings['file_directory']
-        self.private_key_file = settings['ssh_priv_key']
-        self.account = args.worker_account
+        self.account = account
+        self.backend = backend_from_settings(settings, account)
+        self.parallel = asbool(settings.get('worker_parallel', False))
+        self.build_cache_size = int(settings.get('worker_build_cache_size', 0))
+        self.compiler_cache_size = int(settings.get(
+            'worker_compiler_cache_size', 0))
+        self.make_jobs = int(settings.get('worker_make_jobs', 1))
+        self.shard_size = int(settings.get('worker_shard_size', 0))
+        self.file_cache_size = int(settings.get('worker_file_cache_size',
+                                                1 << 30))
+        self.sandbox_links = asbool(settings.get('worker_sandbox_links',
+                                                 False))
+        self.scratch_root = settings.get('worker_scratch_root') or None
+        self.time_limits = (
+            float(settings.get('worker_time_limit_multiplier', 4)),
+            float(settings.get('worker_time_limit_floor', 1)),
+            float(settings.get('worker_time_limit_ceiling', 32)))
+        # Additional jobs are taken directly from the queues when batching
+        self.batch_size = int(settings.get('worker_batch_size', 1))
+        self.batch_wait = float(settings.get('worker_batch_wait', 50)) / 1000
+        self.queue = JobQueue(settings['queue_server'],
+                              settings['queue_tell_worker'],
+                              settings.get('queue_tell_worker_error'))
         machines = settings['worker_machines']
         if isinstance(machines, basestring):
             machines = [machines]
         random.shuffle(machines)
-        self.machines = [(5., x) for x in machines]
-        engine = engine_from_config(settings, 'sqlalchemy.')
-        configure_sql(engine)
-
-        worker = amqp_worker.AMQPWorker(
-            settings['queue_server'], settings['queue_tell_worker'],
-            self.do_work, is_daemon=args.daemon,
-            error_queue=settings.get('queue_tell_worker_error'),
-            log_file=settings['worker_proxy_log_file'].format(self.account),
-            pid_file=settings['worker_proxy_pid_file'].format(self.account),
-            email_subject='WorkerProxy {} Exception'.format(self.account),
-            email_from=settings['exc_mail_from'],
-            email_to=settings['exc_mail_to'])
-
-        worker.handle_command(args.command)
+        weights = settings.get('worker_machine_weights') or []
+        if isinstance(weights, basestring):
+            weights = weights.split()
+        self.scheduler = MachineScheduler(
+            machines, weights=dict(x.split('=', 1) for x in weights),
+            failure_threshold=int(settings.get('worker_failure_threshold',
+                                               3)),
+            reset_timeout=float(settings.get('worker_reset_timeout', 60)),
+            probe=self.backend.ping, slots=slots)
+        self.probe_interval = float(settings.get('worker_probe_interval', 30))
+        self.probing = False
 
     @workers.wrapper
-    def do_work(self, submission_id, testable_id, update_project=False):
-        # Verify job
-        submission = Submission.fetch_by_id(submission_id)
-        if not submission:
-            raise HandledError('Invalid submission id: {0}'
-                               .format(submission_id))
-        testable = Testable.fetch_by_id(testable_id)
-        if not testable:
-            raise HandledError('Invalid testable id: {0}'.format(testable_id))
-        if update_project and submission.project.status != u'locked':
-            raise HandledError('Rejecting update to unlocked project: {0}'
-                               .format(submission.project.id))
-        if update_project and not testable.is_locked:
-            raise HandledError('Rejecting update to unlocked testable: {0}'
-                               .format(testable_id))
+    def do_batch(self, jobs):
+        """Run several jobs in a single round trip to one machine.
+
+        `jobs` is a list of dictionaries of do_work's arguments. Each job's
+        results are committed separately. Return a list containing, for each
+        job, None when it succeeded or the exception that made it fail.
+
+        """
+        errors, bundle, pending = self.prepare_jobs(jobs)
+        if not bundle:
+            return errors
+        machine, results = self.run_shards(bundle)
+        return self.store_bundle(jobs, bundle, pending, errors, machine,
+                                 results)
+
+    def do_work(self, submission_id, testable_id, update_project=False,
+                queued_at=None, deferred=False, test_case_ids=None,
+                class_id=None, group_id=None):
+        """Run the job along with up to `worker_batch_size - 1` other jobs.
+
+        The other jobs are those arriving on the queues within
+        `worker_batch_wait` milliseconds. Jobs of superseded submissions are
+        deferred or dropped rather than run, unless they were deferred
+        already. When `test_case_ids` is given only those test cases are run
+        and their results merged into the existing ones. `class_id` and
+        `group_id` are used by the WorkerPool's fair share scheduling.
+
+        """
+        if not self.probing:  # Started here as daemonizing drops threads
+            self.scheduler.start(self.probe_interval)
+            self.probing = True
+            metrics.start()
+        jobs = [{'submission_id': submission_id, 'testable_id': testable_id,
+                 'update_project': update_project, 'queued_at': queued_at,
+                 'deferred': deferred, 'test_case_ids': test_case_ids,
+                 'class_id': class_id, 'group_id': group_id}]
+        extra = []
+        if self.batch_size > 1:
+            extra = self.queue.get_batch(self.batch_size - 1,
+                                         self.batch_wait)
+        try:
+            errors = self.do_batch(jobs + [x[1] for x in extra])
+        except Exception:
+            for delivery_tag, _ in extra:
+                self.queue.reject(delivery_tag)
+            raise
+        for (delivery_tag, job), error in zip(extra, errors[1:]):
+            if isinstance(error, Superseded):
+                self.queue.requeue_superseded(job)
+            elif error:
+                workers.log_msg('{0}.{1} failed: {2!r}'.format(
+                    job['submission_id'], job['testable_id'], error))
+                self.queue.publish_error(job)
+            self.queue.ack(delivery_tag)
+        if isinstance(errors[0], Superseded):
+            self.queue.requeue_superseded(jobs[0])
+        elif errors[0]:
+            raise errors[0]
+
+    def job_files(self, submission, testable, update_project=False,
+                  test_case_ids=None):
+        """Return the job's (files, data) tuple.
+
+        `files` maps the job's relative paths to the sha1 of their contents
+        and `data` is the job's data.json specification. When `test_case_ids`
+        is given, only those test cases are run.
+
+        """
+        submitted = {x.filename: x.file.sha1 for x in submission.files}
+        build_files = {x.filename: x.file.sha1 for x in testable.build_files}
+        files = {}
+
+        # Prepare build directory with the relevant submission files
+        for filev in testable.file_verifiers:
+            if filev.filename in submitted:
+                files[os.path.join('src', filev.filename)] = \
+                    submitted[filev.filename]
+                if filev.filename in build_files:
+                    del build_files[filev.filename]
+            elif not filev.optional:
+                raise HandledError('File verifier not satisfied: {0}'
+                                   .format(filev.filename))
+        for name, sha1 in build_files.items():  # Add remaining build files
+            files[os.path.join('src', name)] = sha1
+
+        # Add Makefile to current directory if necessary
+        if submission.project.makefile and testable.make_target:
+            files['Makefile'] = submission.project.makefile.sha1
+
+        # Add test inputs and copy build test case specifications
+        test_cases = []
+        for test_case in testable.test_cases:
+            if test_case_ids is not None and test_case.id not in test_case_ids:
+                continue
+            test_cases.append(test_case.serialize())
+            if update_project:  # Reference runs are used for calibration
+                test_cases[-1]['time_limit'] = self.time_limits[2]
+            if test_case.stdin:
+                files[os.path.join('inputs', test_case.stdin.sha1)] = \
+                    test_case.stdin.sha1
+
+        # Add execution files
+        for execution_file in testable.execution_files:
+            files[os.path.join('execution_files',
+                               execution_file.filename)] = \
+                execution_file.file.sha1
+        # Add sumbitted files that should be in the execution environment
+        for filev in testable.file_verifiers:
+            if filev.copy_to_execution and filev.filename in submitted:
+                files[os.path.join('execution_files', filev.filename)] = \
+                    submitted[filev.filename]
+
+        # Generate data dictionary
+        data = {'build_cache_size': self.build_cache_size,
+                'compiler_cache_size': self.compiler_cache_size,
+                'executable': testable.executable,
+                'key': '{}.{}'.format(submission.id, testable.id),
+                'make_jobs': self.make_jobs,
+                'make_target': testable.make_target,
+                'parallel': self.parallel,
+                'sandbox_links': self.sandbox_links,
+                'scratch_root': self.scratch_root,
+                'test_cases': test_cases}
+        return files, data
 
+    def prepare_jobs(self, jobs):
+        """Verify the jobs and return an (errors, bundle, pending) tuple.
+
+        `bundle` maps job directory names to the job's (files, data) and
+        `pending` maps them to the job's (index, fingerprint, project id).
+        Neither holds database objects.
+
+        """
+        errors = [None] * len(jobs)
+        bundle = {}  # Mapping of job directory names to their (files, data)
+        pending = {}  # Mapping of job directory names to pending's tuples
+        for index, job in enumerate(jobs):
+            update_project = job.get('update_project', False)
+            try:
+                submission, testable = self.verify_job(
+                    job['submission_id'], job['testable_id'], update_project)
+                if not update_project and not job.get('deferred') and \
+                        is_superseded(submission):
+                    raise Superseded('{0}.{1} superseded'.format(
+                        job['submission_id'], job['testable_id']))
+                name = 'job_{0}'.format(index)
+                bundle[name] = self.job_files(submission, testable,
+                                              update_project,
+                                              job.get('test_case_ids'))
+            except (HandledError, Superseded) as exc:
+                errors[index] = exc
+                continue
+            pending[name] = (index, None if update_project
+                             else testable.fingerprint(submission),
+                             submission.project_id)
+            if job.get('queued_at'):
+                metrics.observe('queue_wait', time.time() - job['queued_at'],
+                                project=submission.project_id)
+        return errors, bundle, pending
+
+    def push_files(self, machine, bundle, root='.'):
+        """Write the bundle of jobs to the directory root and push it."""
+        for name in os.listdir(root):  # Remove files of a failed attempt
+            path = os.path.join(root, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+        if self.backend.file_cache:
+            # Only send the manifests and the files the machine lacks
+            sha1s = set()
+            for files, _ in bundle.values():
+                sha1s.update(files.values())
+            os.mkdir(os.path.join(root, 'blobs'))
+            for sha1 in self.backend.missing_files(machine, sha1s):
+                os.symlink(File.file_path(self.base_file_path, sha1),
+                           os.path.join(root, 'blobs', sha1))
+
+        for name, (files, data) in bundle.items():
+            name = os.path.join(root, name)
+            os.mkdir(name)
+            if self.backend.file_cache:
+                data = dict(data, cache_size=self.file_cache_size,
+                            files=files)
+            else:
+                # Symlink the files into the directory to sync
+                for directory in ('src', 'inputs', 'execution_files'):
+                    os.mkdir(os.path.join(name, directory))
+                for path, sha1 in files.items():
+                    os.symlink(File.file_path(self.base_file_path, sha1),
+                               os.path.join(name, path))
+            # Save data specification
+            with open(os.path.join(name, 'data.json'), 'w') as fp:
+                json.dump(data, fp)
+
+        # Transfer files
+        self.backend.push(machine, root)
+
+    def run_bundle(self, bundle, root='.', exclude=None):
+        """Run the bundle, prepared in root, on the best machine.
+
+        Return a tuple of the machine the bundle ran on and its results as
+        returned by the backend's `run`. Machines in the set `exclude` are
+        not used, and the machine running the bundle is in the set until
+        it finishes.
+
+        """
+        keys = ' '.join(sorted(x[1]['key'] for x in bundle.values()))
         attempt = 0
         while attempt < 16:
             # Fetch the best machine
-            priority, machine = heappop(self.machines)
+            machine = self.scheduler.acquire(exclude)
             # Log the start of the job
-            workers.log_msg('{}.{} begin ({})'
-                            .format(submission_id, testable_id, machine))
+            workers.log_msg('{} begin ({})'.format(keys, machine))
             log_type = 'unhandled'
+            latency = None
             try:
-                # Kill any processes on the worker
-                priority = self.kill_processes(machine)
+                # Check that the machine is reachable
+                with metrics.timer('prepare', machine=machine):
+                    latency = self.backend.prepare(machine)
                 # Copy the files to the worker (and remove existing files)
-                self.push_files(machine, submission, testable)
-                # Run the remote worker
-                self.ssh(machine, 'python worker.py')
-                # Fetch and generate the results
-                self.fetch_results(machine, submission, testable,
-                                   update_project)
+                with metrics.timer('push', machine=machine):
+                    self.push_files(machine, bundle, root)
+                # Run the worker, which streams back the results
+                with metrics.timer('run', machine=machine):
+                    results = self.backend.run(machine)
                 log_type = 'success'
-                return
-            except SSHConnectTimeout:  # Retry with a different host
+                return machine, results
+            except (AgentError, SSHConnectTimeout):  # Retry a different host
                 attempt += 1
                 log_type = 'timeout'
-                priority += 10
-            except Exception:  # Increase priority and rereaise the exception
+            except Exception:  # Record the failure and rereaise
                 log_type = 'exception'
-                priority += 5
                 raise
             finally:
-                # Add the machine back to the queue
-                heappush(self.machines, (priority, machine))
+                # Return the machine to the scheduler, which wakes waiters
+                if exclude is not None:
+                    exclude.discard(machine)
+                self.scheduler.release(machine, latency=latency,
+                                       failed=log_type != 'success')
+                metrics.increment('attempts', machine=machine,
+                                  outcome=log_type)
                 # Log the end of the job
-                workers.log_msg('{}.{} {} ({})'.format(submission_id,
-                                                       testable_id, log_type,
-                                                       machine))
-        raise Exception('{}.{} timed out 16 times.'
-                        .format(submission_id, testable_id))
-
-    def fetch_results(self, machine, submission, testable, update_project):
-        # Rsync to retrieve results
-        self.rsync(machine)
-        os.chdir('results')
-
+                workers.log_msg('{} {} ({})'.format(keys, log_type, machine))
+        raise Exception('{} timed out 16 times.'.format(keys))
+
+    def run_shards(self, bundle, root='.'):
+        """Run the bundle, split by `shard_bundle`, on several machines.
+
+        Each shard is prepared in its own directory within root and runs on
+        a different machine. Return a tuple of the machines (joined by `+`)
+        and the bundle's results, where the shards' results of each job are
+        merged. Any shard's exception is raised once every shard finished.
+
+        """
+        shards = self.shard_bundle(bundle)
+        if len(shards) == 1:
+            return self.run_bundle(bundle, root)
+        outcomes = [None] * len(shards)
+        exclude = set()
+
+        def run(index):
+            path = tempfile.mkdtemp(dir=root)
+            try:
+                outcomes[index] = self.run_bundle(shards[index], path,
+                                                  exclude)
+            except Exception as exc:
+                if not isinstance(exc, HandledError):
+                    workers.log_msg(traceback.format_exc())
+                outcomes[index] = exc
+            finally:
+                shutil.rmtree(path)
+        threads = [threading.Thread(target=run, args=(x,))
+                   for x in range(len(shards))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                raise outcome
+        results = {}
+        for name in bundle:
+            merged = merge_results([y[1].get(name, {}) for x, y
+                                    in zip(shards, outcomes) if name in x])
+            if merged:
+                results[name] = merged
+        return '+'.join(sorted(set(x[0] for x in outcomes))), results
+
+    def shard_bundle(self, bundle):
+        """Return a list of bundles splitting the test cases of large jobs.
+
+        Jobs with more than `shard_size` test cases are split into as many
+        shards of at most that size as there are machines, each of which
+        builds the job and runs its share of the test cases. Other jobs are
+        left in the first shard.
+
+        """
+        count = 1
+        if self.shard_size:
+            count = min(len(self.scheduler.machines), max(
+                -(-len(x[1]['test_cases']) // self.shard_size)
+                for x in bundle.values()))
+        if count < 2:
+            return [bundle]
+        shards = [{} for _ in range(count)]
+        for name, (files, data) in bundle.items():
+            test_cases = data['test_cases']
+            parts = min(count, -(-len(test_cases) // self.shard_size))
+            for index in range(parts):
+                subset = test_cases[index::parts]  # Interleave for balance
+                inputs = set(os.path.join('inputs', x['stdin'])
+                             for x in subset if x['stdin'])
+                shards[index][name] = (
+                    {x: y for x, y in files.items() if x in inputs or
+                     not x.startswith('inputs' + os.sep)},
+                    dict(data, test_cases=subset))
+        return shards
+
+    def store_bundle(self, jobs, bundle, pending, errors, machine, results):
+        """Store the results of the bundle's jobs.
+
+        Each job is committed separately and its failure recorded in errors,
+        which is returned.
+
+        """
+        for name, (index, fingerprint, project) in sorted(pending.items()):
+            job = jobs[index]
+            try:
+                if 'testable' not in results.get(name, {}):
+                    raise Exception('Worker failed on {0} for {1}'.format(
+                        machine, bundle[name][1]['key']))
+                # Objects do not outlive the previous job's commit
+                self.store_results(
+                    results[name],
+                    Submission.fetch_by_id(job['submission_id']),
+                    Testable.fetch_by_id(job['testable_id']),
+                    job.get('update_project', False), fingerprint,
+                    job.get('test_case_ids'))
+                with metrics.timer('commit', machine=machine,
+                                   project=project):
+                    transaction.commit()
+            except Exception as exc:
+                transaction.abort()
+                errors[index] = exc
+            metrics.increment('jobs', machine=machine, project=project,
+                              status='failed' if errors[index] else 'success')
+        return errors
+
+    def store_results(self, files, submission, testable, update_project,
+                      fingerprint=None, test_case_ids=None):
+        """Save the job's results.
+
+        `files` maps the names of the job's results files to their contents.
+        When `test_case_ids` is given the job ran only those test cases, and
+        the results of the others are kept and counted towards the points.
+
+        """
         # Create dictionary of completed test_cases
-        if os.path.isfile('test_cases'):
-            with open('test_cases') as fp:
-                results = {int(x[0]): x[1] for x in json.load(fp).items()}
+        if 'test_cases' in files:
+            results = {int(x[0]): x[1] for x
+                       in json.loads(files['test_cases']).items()}
         else:
             results = {}
 
         if update_project:
-            set_expected_files(testable, results, self.base_file_path)
+            set_expected_files(testable, results, self.base_file_path,
+                               self.time_limits, files)
             return
 
         points = 0
@@ -155,7 +533,13 @@ class WorkerProxy():
         for test_case in testable.test_cases:
             test_case_result = TestCaseResult.fetch_by_ids(submission.id,
                                                            test_case.id)
-            if test_case.id not in results:
+            if test_case_ids is not None and \
+                    test_case.id not in test_case_ids:
+                if test_case_result and test_case.output_type == 'diff' and \
+                        test_case_result.status == 'success' and \
+                        test_case_result.diff is None:
+                    points += test_case.points
+            elif test_case.id not in results:
                 if test_case_result:  # Delete existing result
                     Session.delete(test_case_result)
             else:
@@ -166,128 +550,75 @@ class WorkerProxy():
                     results[test_case.id]['test_case_id'] = test_case.id
                     test_case_result = TestCaseResult(**results[test_case.id])
                     Session.add(test_case_result)
-                output_file = 'tc_{0}'.format(test_case.id)
+                output = files.get('tc_{0}'.format(test_case.id))
                 if test_case.output_type == 'diff':
-                    matches = compute_diff(test_case, test_case_result,
-                                           output_file, self.base_file_path)
+                    with metrics.timer('diff', project=testable.project_id):
+                        matches = compute_diff(test_case, test_case_result,
+                                               output or '',
+                                               self.base_file_path)
                     if matches and test_case_result.status == 'success':
                         points += test_case.points
                 else:
-                    if os.path.isfile(output_file):  # Store file as the diff
+                    if output is not None:  # Store file as the diff
                         test_case_result.diff = File.fetch_or_create(
-                            open(output_file).read(), self.base_file_path)
+                            output, self.base_file_path)
 
         # Create or update Testable
-        testable_data = json.load(open('testable'))
-        TestableResult.fetch_or_create(
+        testable_data = json.loads(files['testable'])
+        if 'make_time' in testable_data:
+            metrics.observe('make', testable_data['make_time'],
+                            project=testable.project_id)
+        for name, count in testable_data.get('compiler_cache', {}).items():
+            metrics.increment('compiler_cache_' + name, count,
+                              project=testable.project_id)
+        testable_result = TestableResult.fetch_or_create(
             make_results=testable_data.get('make'), points=points,
             status=testable_data['status'], testable=testable,
             submission=submission)
+        testable_result.fingerprint = fingerprint
+        if test_case_ids is None:  # Partial runs would skew the estimates
+            testable_result.duration = testable_data.get('duration')
 
-    def kill_processes(self, machine):
-        expected = 'Connection to {} closed by remote host.'.format(machine)
-        start = time.time()
-        try:
-            self.ssh(machine, 'killall -9 -u {}'.format(self.account),
-                     timeout=1)
-            raise Exception('killall did not work as expected')
-        except subprocess.CalledProcessError as exc:
-            if exc.returncode != 255 or exc.output.strip() != expected:
-                raise Exception('killall status: {} ({})'
-                                .format(exc.returncode, exc.output.strip()))
-        return time.time() - start
-
-    def push_files(self, machine, submission, testable):
-        submitted = {x.filename: x.file.sha1 for x in submission.files}
-        build_files = {x.filename: x.file.sha1 for x in testable.build_files}
-
-        # Prepare build directory by symlinking the relevant submission files
-        os.mkdir('src')
-        for filev in testable.file_verifiers:
-            if filev.filename in submitted:
-                source = File.file_path(self.base_file_path,
-                                        submitted[filev.filename])
-                os.symlink(source, os.path.join('src', filev.filename))
-                if filev.filename in build_files:
-                    del build_files[filev.filename]
-            elif not filev.optional:
-                raise HandledError('File verifier not satisfied: {0}'
-                                   .format(filev.filename))
-        for name, sha1 in build_files.items():  # Symlink remaining build files
-            source = File.file_path(self.base_file_path, sha1)
-            os.symlink(source, os.path.join('src', name))
-
-        # Symlink Makefile to current directory if necessary
-        if submission.project.makefile and testable.make_target:
-            source = File.file_path(self.base_file_path,
-                                    submission.project.makefile.sha1)
-            os.symlink(source, 'Makefile')
-
-        # Symlink test inputs and copy build test case specifications
-        os.mkdir('inputs')
-        test_cases = []
-        for test_case in testable.test_cases:
-            test_cases.append(test_case.serialize())
-            if test_case.stdin:
-                destination = os.path.join('inputs', test_case.stdin.sha1)
-                if not os.path.isfile(destination):
-                    source = File.file_path(self.base_file_path,
-                                            test_case.stdin.sha1)
-                    os.symlink(source, destination)
-
-        # Copy execution files
-        os.mkdir('execution_files')
-        for execution_file in testable.execution_files:
-            destination = os.path.join('execution_files',
-                                       execution_file.filename)
-            source = File.file_path(self.base_file_path,
-                                    execution_file.file.sha1)
-            os.symlink(source, destination)
-        # Symlink sumbitted files that should be in the execution environment
-        for filev in testable.file_verifiers:
-            if filev.copy_to_execution and filev.filename in submitted:
-                destination = os.path.join('execution_files', filev.filename)
-                source = File.file_path(self.base_file_path,
-                                        submitted[filev.filename])
-                os.symlink(source, destination)
-
-        # Generate data dictionary
-        data = {'executable': testable.executable,
-                'key': '{}.{}'.format(submission.id, testable.id),
-                'make_target': testable.make_target,
-                'test_cases': test_cases}
-
-        # Save data specification
-        with open('data.json', 'w') as fp:
-            json.dump(data, fp)
-
-        # Rsync files
-        self.rsync(machine, from_local=True)
-
-    def rsync(self, machine, from_local=False):
-        src = '{}@{}:working/'.format(self.account, machine)
-        dst = '.'
-        if from_local:
-            src, dst = dst, src
-        cmd = ('rsync -e \'ssh -i {}\' --timeout=16 --delete -rLpv {} {}'
-               .format(self.private_key_file, src, dst))
-        subprocess.check_call(cmd, stdout=open(os.devnull, 'w'), shell=True)
-
-    def ssh(self, machine, command, timeout=None):
-        options = '-o ConnectTimeout={}'.format(timeout) if timeout else ''
-        cmd = 'ssh -i {key} {options} {user}@{host} {command}'.format(
-            key=self.private_key_file, user=self.account, host=machine,
-            command=command, options=options)
-        proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
-            if stderr.strip().endswith('Connection timed out'):
-                raise SSHConnectTimeout()
-            output = stdout + '\n' + stderr if stdout else stderr
-            raise subprocess.CalledProcessError(proc.returncode, cmd,
-                                                output=output)
+    def verify_job(self, submission_id, testable_id, update_project=False):
+        """Return the job's submission and testable after validating them."""
+        submission = Submission.fetch_by_id(submission_id)
+        if not submission:
+            raise HandledError('Invalid submission id: {0}'
+                               .format(submission_id))
+        testable = Testable.fetch_by_id(testable_id)
+        if not testable:
+            raise HandledError('Invalid testable id: {0}'.format(testable_id))
+        if update_project and submission.project.status != u'locked':
+            raise HandledError('Rejecting update to unlocked project: {0}'
+                               .format(submission.project.id))
+        if update_project and not testable.is_locked:
+            raise HandledError('Rejecting update to unlocked testable: {0}'
+                               .format(testable_id))
+        return submission, testable
 
 
 def main():
-    WorkerProxy()
+    parser = amqp_worker.base_argument_parser()
+    parser.add_argument('worker_account', type=str)
+    args, settings = amqp_worker.parse_base_args(parser, 'app:main')
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    configure_sql(engine)
+    workers.SUPERSEDED = settings.get('superseded_submissions', 'defer')
+    account = args.worker_account
+    metrics.path = settings.get('worker_metrics_file', '').format(account) \
+        or None
+    proxy = WorkerProxy(settings, account)
+    atexit.register(proxy.backend.close)
+
+    worker = amqp_worker.AMQPWorker(
+        settings['queue_server'], settings['queue_tell_worker'],
+        proxy.do_work, is_daemon=args.daemon,
+        error_queue=settings.get('queue_tell_worker_error'),
+        log_file=settings['worker_proxy_log_file'].format(account),
+        pid_file=settings['worker_proxy_pid_file'].format(account),
+        email_subject='WorkerProxy {} Exception'.format(account),
+        email_from=settings['exc_mail_from'],
+        email_to=settings['exc_mail_to'])
+
+    worker.handle_command(args.command)
@@ -0,0 +1,115 @@
+import json
+import pika
+import pika.exceptions
+import time
+from .. import workers
+
+
+class JobQueue(object):
+
+    """A minimal client for taking jobs directly from the worker queues.
+
+    `queues` are listed from highest to lowest priority. Jobs are returned as
+    (delivery_tag, kwargs) tuples and must be acknowledged, or rejected so
+    they are redelivered, once handled.
+
+    """
+
+    def __init__(self, server, queues, error_queue=None, poll_interval=0.01):
+        if isinstance(queues, basestring):
+            queues = [queues]
+        self.server = server
+        self.queues = queues
+        self.error_queue = error_queue
+        self.poll_interval = poll_interval
+        self.connection = self.channel = None
+
+    def ack(self, delivery_tag):
+        if self.channel is None:
+            self.connect()
+        self.channel.basic_ack(delivery_tag=delivery_tag)
+
+    def connect(self):
+        if self.connection and self.connection.is_open:
+            self.connection.close()
+        self.connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=self.server))
+        self.channel = self.connection.channel()
+
+    def depth(self):
+        """Return the number of jobs waiting on the queues."""
+        if not self.connection or not self.connection.is_open:
+            self.connect()
+        return sum(self.channel.queue_declare(queue=x, passive=True)
+                   .method.message_count for x in self.queues)
+
+    def get(self):
+        """Return the highest priority pending job, or None."""
+        for queue in self.queues:
+            method, _, body = self.channel.basic_get(queue=queue)
+            if method:
+                kwargs = json.loads(body)
+                kwargs.pop('_priority', None)
+                return method.delivery_tag, kwargs
+        return None
+
+    def get_batch(self, size, timeout):
+        """Return up to `size` jobs, waiting at most `timeout` seconds.
+
+        The connection is (re)established as needed before the first job is
+        taken, as it may have been closed while idle.
+
+        """
+        try:
+            if not self.connection or not self.connection.is_open:
+                self.connect()
+            first = self.get()
+        except pika.exceptions.AMQPConnectionError:
+            self.connect()
+            first = self.get()
+        batch = [first] if first else []
+        deadline = time.time() + timeout
+        while len(batch) < size:
+            job = self.get()
+            if job:
+                batch.append(job)
+            elif time.time() < deadline:
+                time.sleep(self.poll_interval)
+            else:
+                break
+        return batch
+
+    def publish(self, kwargs, queue=None):
+        """Send a job's arguments to queue, by default the lowest priority.
+
+        The connection is established as needed, as a proxy that takes a
+        single job at a time never opens it otherwise.
+
+        """
+        if self.channel is None:
+            self.connect()
+        self.channel.basic_publish(
+            exchange='', body=json.dumps(kwargs),
+            routing_key=queue or self.queues[-1],
+            properties=pika.BasicProperties(delivery_mode=2))
+
+    def publish_error(self, kwargs):
+        """Send a failed job's arguments to the error queue."""
+        if self.error_queue:
+            self.publish(kwargs, self.error_queue)
+
+    def requeue_superseded(self, kwargs):
+        """Defer or drop a job whose submission has been superseded.
+
+        Deferred jobs are sent back to the lowest priority queue, flagged so
+        that they are graded once they reach the front.
+
+        """
+        if workers.SUPERSEDED == 'defer':
+            self.publish(dict(kwargs, deferred=True))
+
+    def reject(self, delivery_tag):
+        """Return the job to its queue."""
+        if self.channel is None:
+            self.connect()
+        self.channel.basic_reject(delivery_tag=delivery_tag, requeue=True)
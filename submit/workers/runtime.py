@@ -0,0 +1,42 @@
+import time
+from ..models import TestableResult
+
+
+class RuntimeEstimator(object):
+
+    """Estimate the duration of jobs from the recent runs of their testable.
+
+    A job's estimate is the median duration of its testable's latest
+    `samples` results, which is refetched once older than `max_age`
+    seconds. Jobs of testables without a recorded duration are expected to
+    take `default` seconds.
+
+    """
+
+    def __init__(self, default=10., samples=20, max_age=300):
+        self.default = default
+        self.samples = samples
+        self.max_age = max_age
+        self.estimates = {}  # Mapping of testable ids to (seconds, time)
+
+    def __call__(self, item):
+        """Return the expected duration of a (delivery_tag, job) tuple."""
+        estimate = self.estimates.get(item[1].get('testable_id'))
+        if not estimate or estimate[0] is None:
+            return self.default
+        return estimate[0]
+
+    def refresh(self, jobs):
+        """Fetch the estimates of the jobs' testables when out of date.
+
+        Testables without a recorded duration are refetched every time.
+        This method must be called within a transaction.
+
+        """
+        now = time.time()
+        for testable_id in set(x.get('testable_id') for x in jobs):
+            estimate = self.estimates.get(testable_id)
+            if not estimate or estimate[0] is None or \
+                    now - estimate[1] > self.max_age:
+                self.estimates[testable_id] = (TestableResult.median_duration(
+                    testable_id, self.samples), now)
@@ -0,0 +1,213 @@
+import threading
+import time
+from .. import workers
+
+
+class MachineState(object):
+
+    """The scheduler's view of a single machine."""
+
+    def __init__(self, name, weight=1., now=0.):
+        self.name = name
+        self.weight = weight
+        self.in_flight = 0
+        self.busy_time = 0.  # Total time spent with jobs in flight
+        self.busy_since = None
+        self.created_at = now
+        self.latency = None  # EWMA of the machine's preparation latency
+        self.failure_rate = 0.  # EWMA of job failures
+        self.failures = 0  # Consecutive failures
+        self.state = 'closed'
+        self.opened_at = None
+
+    @property
+    def capacity(self):
+        """Return the share of work the machine is currently fit for."""
+        if self.state != 'closed':
+            return 0.
+        return self.weight * (1 - self.failure_rate)
+
+    def report(self, now):
+        busy_time = self.busy_time
+        if self.busy_since is not None:
+            busy_time += now - self.busy_since
+        elapsed = now - self.created_at
+        return {'capacity': self.capacity, 'failure_rate': self.failure_rate,
+                'in_flight': self.in_flight, 'latency': self.latency,
+                'state': self.state, 'weight': self.weight,
+                'utilisation': busy_time / elapsed if elapsed > 0 else 0.}
+
+
+class MachineScheduler(object):
+
+    """Choose the machine to run each job on from the machines' health.
+
+    Each machine has a circuit breaker. The circuit opens after
+    `failure_threshold` consecutive failures and the machine is no longer
+    chosen. Once `reset_timeout` seconds have passed the circuit becomes
+    half-open: a single trial job (or a successful `probe`) closes it again,
+    and a failure reopens it. Among the available machines, the one with the
+    lowest load relative to its weight is chosen, where a machine's load
+    accounts for its in-flight jobs, EWMA latency and failure rate. Idle
+    machines are probed periodically, so that a machine that is no longer
+    chosen after a failure or a slow job recovers once it is healthy.
+
+    When `slots` is set, no machine is given more than that many concurrent
+    jobs and `acquire` blocks until a machine has a free slot. `acquire`
+    likewise blocks while every machine is in the set it is told to exclude.
+
+    `probe` is a function taking a machine name and returning its latency or
+    raising an exception. The `clock` and `probe` arguments allow the
+    scheduler to be driven by simulated machines.
+
+    """
+
+    def __init__(self, machines, weights=None, alpha=.3, failure_threshold=3,
+                 reset_timeout=60, probe=None, clock=time.time, slots=None):
+        weights = weights or {}
+        self.machines = {x: MachineState(x, float(weights.get(x, 1)),
+                                         clock()) for x in machines}
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.clock = clock
+        self.slots = slots
+        self.lock = threading.Condition()
+        self._stop = threading.Event()
+
+    def _load(self, machine):
+        latency = machine.latency if machine.latency is not None else 1.
+        return ((machine.in_flight + 1) * (latency + 1) *
+                (1 + 4 * machine.failure_rate) / machine.weight)
+
+    def _open(self, machine):
+        machine.state = 'open'
+        machine.opened_at = self.clock()
+        workers.log_msg('circuit open ({0})'.format(machine.name))
+
+    def _ready(self, machine):
+        """Return whether a trial job or probe may be sent to machine."""
+        return (machine.state == 'open' and
+                self.clock() - machine.opened_at >= self.reset_timeout)
+
+    def _record(self, machine, latency, failed):
+        if latency is not None:
+            machine.latency = latency if machine.latency is None else (
+                self.alpha * latency + (1 - self.alpha) * machine.latency)
+        machine.failure_rate = (self.alpha * failed +
+                                (1 - self.alpha) * machine.failure_rate)
+        if machine.failure_rate < .01:  # Tie again with healthy machines
+            machine.failure_rate = 0.
+        if failed:
+            machine.failures += 1
+            if machine.state == 'half_open' or \
+                    machine.failures >= self.failure_threshold:
+                self._open(machine)
+        else:
+            machine.failures = 0
+            if machine.state != 'closed':
+                workers.log_msg('circuit closed ({0})'.format(machine.name))
+            machine.state = 'closed'
+            machine.opened_at = None
+
+    def acquire(self, exclude=None):
+        """Return the machine for the next job and count it as in flight.
+
+        When every circuit is open, the machine whose circuit opened first
+        is tried so that jobs are never refused. Machines in the set
+        `exclude` are not chosen, and the chosen machine is added to it.
+
+        """
+        with self.lock:
+            while True:
+                machine = self._choose(exclude or ())
+                if machine:
+                    break
+                self.lock.wait()
+            if machine.in_flight == 0:
+                machine.busy_since = self.clock()
+            machine.in_flight += 1
+            if exclude is not None:
+                exclude.add(machine.name)
+            return machine.name
+
+    def _choose(self, exclude=()):
+        """Return the best machine with a free slot, or None."""
+        free = [x for x in self.machines.values()
+                if x.name not in exclude and
+                (self.slots is None or x.in_flight < self.slots)]
+        for machine in free:
+            if self._ready(machine) and machine.in_flight == 0:
+                machine.state = 'half_open'
+        closed = [x for x in free if x.state == 'closed']
+        trials = [x for x in free
+                  if x.state == 'half_open' and x.in_flight == 0]
+        if trials:  # Give recovering machines a chance first
+            return trials[0]
+        elif closed:
+            return min(closed, key=self._load)
+        available = [x for x in free if x.state == 'open']
+        if not available and self.slots is None:
+            available = [x for x in free if x.state != 'probing']
+        if available:
+            return min(available, key=lambda x: x.opened_at or 0)
+        return None
+
+    def check(self):
+        """Probe the idle machines that are closed or ready to be retried.
+
+        The probes' outcomes and latencies are recorded like those of jobs,
+        and machines are not chosen while being probed.
+
+        """
+        if not self.probe:
+            return
+        with self.lock:
+            machines = [x for x in self.machines.values() if x.in_flight == 0
+                        and (x.state == 'closed' or self._ready(x))]
+            states = {x.name: x.state for x in machines}
+            for machine in machines:
+                machine.state = 'probing'
+        for machine in machines:
+            try:
+                latency = self.probe(machine.name)
+                failed = False
+            except Exception:
+                latency = None
+                failed = True
+            with self.lock:
+                machine.state = 'closed' if states[machine.name] == 'closed' \
+                    else 'half_open'
+                self._record(machine, latency, failed)
+                self.lock.notify_all()
+
+    def release(self, machine, latency=None, failed=False):
+        """Record the outcome of a job that ran on machine."""
+        with self.lock:
+            state = self.machines[machine]
+            state.in_flight -= 1
+            if state.in_flight == 0:
+                state.busy_time += self.clock() - state.busy_since
+                state.busy_since = None
+            self._record(state, latency, failed)
+            self.lock.notify_all()
+
+    def report(self):
+        """Return a mapping of each machine to its current statistics."""
+        with self.lock:
+            now = self.clock()
+            return {x.name: x.report(now) for x in self.machines.values()}
+
+    def start(self, interval=30):
+        """Run `check` every interval seconds in a background thread."""
+        def run():
+            while not self._stop.wait(interval):
+                self.check()
+        thread = threading.Thread(target=run, name='scheduler-probe')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,137 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from .exceptions import SSHConnectTimeout
+from .metrics import REGISTRY as metrics
+from .. import workers
+
+
+class SSHConnectionPool(object):
+
+    """Build ssh and rsync commands for the worker machines.
+
+    When `multiplex` is set, one authenticated master connection is kept per
+    machine (via OpenSSH's ControlMaster) and all ssh and rsync traffic is
+    sent through it. Masters are health checked before use, at most once
+    every `check_interval` seconds, and are transparently re-established.
+    Masters exit once unused for `persist` seconds, thus they never outlive
+    the proxy by long even when `close` is not called.
+
+    The number of ssh handshakes performed per machine is tracked in either
+    mode, and exported as the `ssh_handshakes` metric, so that the effect of
+    multiplexing can be measured.
+
+    """
+
+    def __init__(self, account, private_key_file, multiplex=False,
+                 control_dir=None, check_interval=30, persist=300):
+        self.account = account
+        self.private_key_file = private_key_file
+        self.multiplex = multiplex
+        self.own_control_dir = control_dir is None
+        self.control_dir = control_dir  # Created on first use if None
+        self.lock = threading.Lock()
+        self.check_interval = check_interval
+        self.persist = persist
+        self.handshakes = defaultdict(int)
+        self._checked_at = {}
+
+    def _handshake(self, machine):
+        self.handshakes[machine] += 1
+        metrics.increment('ssh_handshakes', machine=machine)
+
+    def check(self, machine):
+        """Return whether the master connection to machine is alive."""
+        cmd = 'ssh -o ControlPath={path} -O check {user}@{host}'.format(
+            path=self.control_path(machine), user=self.account, host=machine)
+        with open(os.devnull, 'w') as devnull:
+            alive = subprocess.call(cmd, shell=True, stdout=devnull,
+                                    stderr=devnull) == 0
+        if alive:
+            self._checked_at[machine] = time.time()
+        else:
+            self._checked_at.pop(machine, None)
+        return alive
+
+    def close(self, machine=None):
+        """Close the master connection to machine (or to all machines).
+
+        Closing all of them also removes the control directory if it was
+        created here.
+
+        """
+        if self.control_dir is None:  # No master was ever started
+            return
+        for host in [machine] if machine else list(self.handshakes):
+            cmd = 'ssh -o ControlPath={path} -O exit {user}@{host}'.format(
+                path=self.control_path(host), user=self.account, host=host)
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(cmd, shell=True, stdout=devnull,
+                                stderr=devnull)
+            self._checked_at.pop(host, None)
+        if not machine and self.own_control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+    def command(self, machine, command, timeout=None):
+        """Return the shell command that runs `command` on machine."""
+        return 'ssh {options} {user}@{host} {command}'.format(
+            options=self.options(machine, timeout=timeout),
+            user=self.account, host=machine, command=command)
+
+    def connect(self, machine, timeout=None):
+        """Ensure a healthy master connection to machine exists."""
+        checked_at = self._checked_at.get(machine)
+        if checked_at and time.time() - checked_at < self.check_interval:
+            return
+        if self.check(machine):
+            return
+        options = '-o ConnectTimeout={}'.format(timeout) if timeout else ''
+        cmd = ('ssh -i {key} {options} -o ControlMaster=yes '
+               '-o ControlPath={path} -o ControlPersist={persist} '
+               '-o ServerAliveInterval=15 -fN {user}@{host}'
+               .format(key=self.private_key_file, options=options,
+                       path=self.control_path(machine), persist=self.persist,
+                       user=self.account, host=machine))
+        self._handshake(machine)
+        workers.log_msg('ssh master connect #{} ({})'
+                        .format(self.handshakes[machine], machine))
+        proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            if stderr.strip().endswith('Connection timed out'):
+                raise SSHConnectTimeout()
+            raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                                output=stderr)
+        self._checked_at[machine] = time.time()
+
+    def control_path(self, machine):
+        with self.lock:
+            if self.control_dir is None:
+                self.control_dir = tempfile.mkdtemp(prefix='ssh_')
+        return os.path.join(self.control_dir,
+                            '{0}@{1}'.format(self.account, machine))
+
+    def invalidate(self, machine):
+        """Force a health check on the next use of machine's connection."""
+        self._checked_at.pop(machine, None)
+
+    def options(self, machine, timeout=None):
+        """Return the ssh options needed to connect to machine."""
+        if self.multiplex:
+            self.connect(machine, timeout=timeout)
+            return '-i {key} -o ControlPath={path}'.format(
+                key=self.private_key_file, path=self.control_path(machine))
+        self._handshake(machine)
+        options = '-o ConnectTimeout={}'.format(timeout) if timeout else ''
+        return '-i {key} {options}'.format(key=self.private_key_file,
+                                           options=options)
+
+    def rsync_shell(self, machine, timeout=None):
+        """Return the value for rsync's -e option for machine."""
+        return 'ssh {0}'.format(self.options(machine, timeout=timeout))
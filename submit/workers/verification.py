@@ -1,7 +1,10 @@
 import amqp_worker
+import time
+from pyramid.settings import asbool
 from sqlalchemy import engine_from_config
+from .metrics import REGISTRY as metrics
 from .. import workers
-from ..models import Submission, configure_sql
+from ..models import Submission, TestableResult, configure_sql
 
 # Hack for old pickle files
 # TODO: Migrate this data to not use pickle
@@ -12,19 +15,92 @@ sys.modules['nudibranch.diff_unit'] = submit.diff_unit
 sys.modules['nudibranch.models'] = submit.models
 
 
+def reuse_results(submission, testables):
+    """Copy results from earlier byte-identical submissions.
+
+    Return the testables that still need to be sent to the workers.
+
+    """
+    pending = []
+    for testable in testables:
+        fingerprint = testable.fingerprint(submission)
+        earlier = TestableResult.fetch_reusable(submission, testable,
+                                                fingerprint)
+        if earlier:
+            earlier.clone_for(submission)
+            workers.log_msg('Reused results for {0}.{1} from {2}'
+                            .format(submission.id, testable.id,
+                                    earlier.submission_id))
+        else:
+            pending.append(testable)
+    return pending
+
+
+def is_superseded(submission):
+    """Return whether grading submission should yield to a later one.
+
+    The submission is marked as superseded when a later submission by the
+    same group exists, unless superseded submissions are graded as usual.
+
+    """
+    if workers.SUPERSEDED == 'grade' or \
+            not Submission.later_submission_for_group(submission):
+        return False
+    if not submission.is_superseded:
+        submission.is_superseded = True
+        workers.log_msg('Superseded: {0}'.format(submission.id))
+    return True
+
+
+def regrade_jobs(submission, testables, test_case_ids):
+    """Return the jobs running only the given test cases of each testable.
+
+    Testables without any of the test cases are left alone. Those without a
+    result for the submission are run in full.
+
+    """
+    test_case_ids = set(test_case_ids)
+    retval = []
+    for testable in testables:
+        ids = sorted(x.id for x in testable.test_cases
+                     if x.id in test_case_ids)
+        if not ids:
+            continue
+        if not TestableResult.fetch_by(submission=submission,
+                                       testable=testable):
+            ids = None
+        retval.append({'class_id': submission.project.class_id,
+                       'group_id': submission.group_id,
+                       'submission_id': submission.id,
+                       'testable_id': testable.id, 'test_case_ids': ids,
+                       'queued_at': time.time()})
+    return retval or None
+
+
 @workers.wrapper
-def do_work(submission_id, update_project=False):
+def do_work(submission_id, update_project=False, queued_at=None,
+            test_case_ids=None):
+    metrics.start()  # Started here as daemonizing drops threads
     submission = Submission.fetch_by_id(submission_id)
     if not submission:
         workers.log_msg('Invalid submission id: {0}'.format(submission_id))
         return
+    if queued_at:
+        metrics.observe('verification_queue_wait', time.time() - queued_at,
+                        project=submission.project_id)
     if update_project and not submission.project.status == u'locked':
         workers.log_msg('Project to update is not locked: {0}'
                         .format(submission_id))
         return
-    # Verify and update submission
-    valid_testables = submission.verify(workers.BASE_FILE_PATH,
-                                        update=not update_project)
+    # Verify and update submission, keeping the results of a regrade
+    with metrics.timer('verification', project=submission.project_id):
+        valid_testables = submission.verify(
+            workers.BASE_FILE_PATH,
+            update=not update_project and test_case_ids is None)
+    if test_case_ids is not None and not update_project:
+        workers.log_msg('Regrading test cases {0} of {1}'
+                        .format(test_case_ids, submission_id))
+        return regrade_jobs(submission, valid_testables, test_case_ids)
 
     # All testables must be valid in order to update the project
     if update_project:
@@ -43,9 +119,20 @@ def do_work(submission_id, update_project=False):
             break
     if valid_testables:
         workers.log_msg('Passed: {0}'.format(submission_id))
-        retval = [{'submission_id': submission_id, 'testable_id': x.id,
-                   'update_project': update_project}
-                  for x in valid_testables]
+        if not update_project and workers.REUSE_RESULTS:
+            with metrics.timer('reuse', project=submission.project_id):
+                valid_testables = reuse_results(submission, valid_testables)
+        retval = [{'class_id': submission.project.class_id,
+                   'group_id': submission.group_id,
+                   'submission_id': submission_id, 'testable_id': x.id,
+                   'update_project': update_project, 'queued_at': time.time()}
+                  for x in valid_testables] or None
+        if retval and not update_project and is_superseded(submission):
+            if workers.SUPERSEDED == 'skip':
+                retval = None
+            elif workers.SUPERSEDED == 'defer':
+                for job in retval:  # Sent to the lowest priority queue
+                    job.update(_priority=2, deferred=True)
     else:
         workers.log_msg('Failed: {0}'.format(submission_id))
         if update_project:
@@ -60,6 +147,11 @@ def main():
     parser = amqp_worker.base_argument_parser()
     args, settings = amqp_worker.parse_base_args(parser, 'app:main')
     workers.BASE_FILE_PATH = settings['file_directory']
+    workers.REUSE_RESULTS = asbool(settings.get('reuse_identical_results',
+                                                True))
+    workers.SUPERSEDED = settings.get('superseded_submissions', 'defer')
+    metrics.prefix = 'submit_verification'
+    metrics.path = settings.get('verification_metrics_file') or None
 
     engine = engine_from_config(settings, 'sqlalchemy.')
     configure_sql(engine)
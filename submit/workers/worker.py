@@ -1,17 +1,28 @@
 #!/usr/bin/env python
+import base64
+import ctypes
 import errno
 import json
 import os
 import shlex
+import resource
 import shutil
 import select
 import signal
 import socket
+import stat
+import struct
 import sys
 import tempfile
+import threading
 import time
 import traceback
+import zlib
+from collections import defaultdict
 from datetime import datetime
+from hashlib import sha1
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE, STDOUT
 
 
@@ -19,77 +30,395 @@ SRC_PATH = 'src'
 INPUT_PATH = 'inputs'
 RESULTS_PATH = 'results'
 EXECUTION_FILES_PATH = 'execution_files'
+BUILD_CACHE_PATH = 'build_cache'
+COMPILER_CACHE_PATH = 'compiler_cache'
+CACHE_PATH = 'cache'
+INCOMING_PATH = 'incoming'
+
+CACHE_SIZE = 1 << 30
 
 MAX_FILE_SIZE = 81920
+FILE_SIZE_LIMIT = 1 << 24  # Bounds every file a test process writes
 TIME_LIMIT = 4
+TIMEOUT_GRACE = 1  # Seconds to drain output held open past the time limit
+
+FRAME_HEADER = struct.Struct('>I')
+PR_SET_CHILD_SUBREAPER = 36
 
 
 def log_msg(msg):
     print('{} {}'.format(datetime.now(), msg))
 
 
+def read_frame(fp):
+    """Return the next framed message from fp, or None at end of stream.
+
+    Each frame is a 4-byte big-endian length followed by a JSON document.
+
+    """
+    header = fp.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    length = FRAME_HEADER.unpack(header)[0]
+    data = fp.read(length)
+    if len(data) < length:
+        return None
+    return json.loads(data)
+
+
+def pack_results(path, names):
+    """Return the results of the bundle's jobs as one compressed stream.
+
+    Each file of a job's results directory is a pair of frames holding its
+    name (e.g., job_0/tc_1) and its contents. Jobs without results are
+    omitted.
+
+    """
+    frames = []
+    for name in sorted(names):
+        results = os.path.join(path, name, RESULTS_PATH)
+        if not os.path.isdir(results):
+            continue
+        for filename in sorted(os.listdir(results)):
+            with open(os.path.join(results, filename), 'rb') as fp:
+                for item in ('{0}/{1}'.format(name, filename), fp.read()):
+                    frames.append(FRAME_HEADER.pack(len(item)))
+                    frames.append(item)
+    return zlib.compress(''.join(frames))
+
+
+def unpack_results(stream):
+    """Return a mapping of job names to their results files' contents."""
+    data = zlib.decompress(stream)
+    items = []
+    offset = 0
+    while offset < len(data):
+        length = FRAME_HEADER.unpack_from(data, offset)[0]
+        offset += FRAME_HEADER.size
+        items.append(data[offset:offset + length])
+        offset += length
+    results = defaultdict(dict)
+    for name, contents in zip(items[::2], items[1::2]):
+        job, filename = name.split('/', 1)
+        results[job][filename] = contents
+    return dict(results)
+
+
+def snapshot(path):
+    """Return a mapping of the files below path to their stat signature.
+
+    The signature includes the ctime, which unlike the mtime cannot be set by
+    the files' owner.
+
+    """
+    files = {}
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            full_path = os.path.join(root, filename)
+            info = os.lstat(full_path)
+            files[os.path.relpath(full_path, path)] = (
+                info.st_ino, info.st_mtime, info.st_ctime, info.st_size)
+    return files
+
+
+def wait_usage(process, start, usage=None, block=True):
+    """Reap process and return its exit status.
+
+    When provided, `usage` is updated with the process's resource usage (as
+    reported by wait4) and the wall time elapsed since `start`. Without
+    `block`, None is returned if the process is still running.
+
+    """
+    if process.returncode is not None:  # Already reaped
+        return process.returncode
+    pid, status, rusage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    if usage is not None:
+        usage.update(cpu_system=rusage.ru_stime, cpu_user=rusage.ru_utime,
+                     max_rss=rusage.ru_maxrss, wall_time=time.time() - start)
+    return process.returncode
+
+
+def write_frame(fp, message):
+    """Write message to fp as a single frame."""
+    data = json.dumps(message)
+    fp.write(FRAME_HEADER.pack(len(data)) + data)
+    fp.flush()
+
+
+def copy_writable(src, dst):
+    """Copy src to dst ensuring the copy is writable by its owner.
+
+    Blobs of the cache, and the hardlinks made to them, are read-only.
+
+    """
+    shutil.copy(src, dst)
+    os.chmod(dst, stat.S_IMODE(os.stat(dst).st_mode) | stat.S_IWUSR)
+
+
+def file_sha1(path):
+    digest = sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_size(path):
+    total = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.lstat(os.path.join(root, filename)).st_size
+    return total
+
+
+def parent_pid(pid):
+    """Return the parent process id of pid."""
+    with open('/proc/{0}/stat'.format(pid)) as fp:
+        # The command name may contain spaces so split after it
+        return int(fp.read().rsplit(')', 1)[1].split()[1])
+
+
+def descendants(pid):
+    """Return the process ids of pid's descendants."""
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                children[parent_pid(int(entry))].append(int(entry))
+            except (IOError, OSError):  # The process already exited
+                pass
+    found = []
+    parents = [pid]
+    while parents:
+        for child in children[parents.pop()]:
+            found.append(child)
+            parents.append(child)
+    return found
+
+
+def kill_descendants():
+    """Kill and reap every descendant of this process.
+
+    Along with set_subreaper this finds the processes that escaped their
+    test's process group, even once the process that started them exited.
+    It must not be called while tests are running.
+
+    """
+    for _ in range(16):
+        pids = descendants(os.getpid())
+        if not pids:
+            return
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for pid in pids:  # Killed children (and orphans adopted since then)
+            try:
+                os.waitpid(pid, 0)
+            except OSError:  # Not a child of this process
+                pass
+
+
+def kill_group(pid):
+    """Kill the process group led by pid if any of its processes remain."""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError as exc:
+        if exc.errno != errno.ESRCH:
+            raise
+
+
+def setup_child():
+    """Prepare a test process before it executes.
+
+    The process leads a new process group and is limited to writing files of
+    at most FILE_SIZE_LIMIT bytes; larger writes kill it with SIGXFSZ, whose
+    default action Python (and thus the child) would otherwise ignore.
+
+    """
+    os.setsid()
+    signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+    resource.setrlimit(resource.RLIMIT_FSIZE,
+                       (FILE_SIZE_LIMIT, FILE_SIZE_LIMIT))
+
+
+def kill_tree(pid):
+    """Kill pid's process group along with every descendant of pid.
+
+    Descendants that started their own session escape kill_group but remain
+    pid's descendants for as long as pid runs.
+
+    """
+    pids = descendants(pid)
+    kill_group(pid)
+    for child in pids:
+        try:
+            os.kill(child, signal.SIGKILL)
+        except OSError:  # The process already exited
+            pass
+
+
+def set_subreaper():
+    """Adopt the orphaned descendants of this process (Linux 3.4+).
+
+    Return whether or not this process is now a child subreaper.
+
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (AttributeError, OSError):
+        return False
+
+
+def kill_strays():
+    """Kill all of this user's processes except for this process's lineage.
+
+    This is the equivalent of `killall -9 -u <account>` run by the agent and
+    batch mode, which leaves them and the ssh session they run in running.
+
+    """
+    uid = os.getuid()
+    if uid == 0:  # Never run as root
+        return
+    keep = set()
+    pid = os.getpid()
+    try:
+        while pid > 1:
+            keep.add(pid)
+            pid = parent_pid(pid)
+    except (IOError, OSError):
+        pass
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit() or int(entry) in keep:
+            continue
+        try:
+            if os.stat(os.path.join('/proc', entry)).st_uid == uid:
+                os.kill(int(entry), signal.SIGKILL)
+        except OSError:  # The process already exited
+            pass
+
+
 class Worker(object):
     @staticmethod
     def execute(command, stderr=None, stdin=None, stdout=None, files=None,
-                save=None):
-        if not stderr:
-            stderr = open('/dev/null', 'w')
-        if not stdout:
-            stdout = open('/dev/null', 'w')
-
-        # Create temporary directory and copy execution files
-        tmp_dir = tempfile.mkdtemp()
-        for filename in os.listdir(EXECUTION_FILES_PATH):
-            shutil.copy(os.path.join(EXECUTION_FILES_PATH, filename),
-                        os.path.join(tmp_dir, filename))
+                save=None, template=None, usage=None, output_limit=None,
+                time_limit=None):
+        """Run command in a sandbox and return its exit status.
 
-        args = shlex.split(command)
-        # allow some programs
-        executable = None
-        if args[0] not in ('bash', 'head', 'python', 'python2', 'python3',
-                           'sh', 'spim', 'tail', 'valgrind'):
-            executable = os.path.normpath(os.path.join(os.getcwd(), SRC_PATH,
-                                                       args[0]))
-            if not os.path.isfile(executable):
-                raise NonexistentExecutable()
+        The command is killed after `time_limit` seconds. Test cases without a
+        calibrated limit fall back to TIME_LIMIT (adjusted for some programs).
+
+        Output sent to the `stdout` and `stderr` files is capped at
+        `output_limit` bytes; the process group is killed and
+        OutputLimitExceeded raised as soon as more is produced, with the
+        output_bytes of `usage` set to the limit.
+
+        """
+
+        # Create temporary directory containing the execution files
+        if template:
+            tmp_dir = template.create()
         else:
-            # Need to copy the script(s) if they are listed on the command line
-            for arg in args:
-                src = os.path.join(SRC_PATH, arg)
-                if os.path.isfile(src):
-                    shutil.copy(src, os.path.join(tmp_dir, arg))
+            tmp_dir = tempfile.mkdtemp()
+            for filename in os.listdir(EXECUTION_FILES_PATH):
+                copy_writable(os.path.join(EXECUTION_FILES_PATH, filename),
+                              os.path.join(tmp_dir, filename))
+
+        args = shlex.split(command)
 
-        # Hacks to give more time to some scripts:
-        time_limit = TIME_LIMIT
-        if args[0] in ('valgrind',):
-            time_limit *= 2
-        elif len(args) > 2 and args[1] == 'turtle_capture.sh':
-            time_limit *= 4  # How can we run this faster?
+        # Hacks to give more time to some uncalibrated scripts:
+        if not time_limit:
+            time_limit = TIME_LIMIT
+            if args[0] in ('valgrind',):
+                time_limit *= 2
+            elif len(args) > 2 and args[1] == 'turtle_capture.sh':
+                time_limit *= 4  # How can we run this faster?
 
-        # Run command with a timelimit
-        # TODO: Do we only get partial output with stdout?
+        # Run command with a timelimit capturing its output through pipes
+        devnull = open(os.devnull, 'w')
         try:
+            # allow some programs
+            executable = None
+            if args[0] not in ('bash', 'head', 'python', 'python2', 'python3',
+                               'sh', 'spim', 'tail', 'valgrind'):
+                executable = os.path.normpath(os.path.join(
+                    os.getcwd(), SRC_PATH, args[0]))
+                if not os.path.isfile(executable):
+                    raise NonexistentExecutable()
+            else:
+                # Copy the script(s) listed on the command line, replacing
+                # rather than writing through the template's read-only links
+                for arg in args:
+                    src = os.path.join(SRC_PATH, arg)
+                    if os.path.isfile(src):
+                        dst = os.path.join(tmp_dir, arg)
+                        if os.path.lexists(dst):
+                            os.remove(dst)
+                        copy_writable(src, dst)
             poll = select.epoll()
-            main_pipe = Popen(args, stdin=stdin, stdout=PIPE, stderr=stderr,
-                              cwd=tmp_dir, preexec_fn=os.setsid,
-                              executable=executable)
-            poll.register(main_pipe.stdout, select.EPOLLIN | select.EPOLLHUP)
-            do_poll = True
+            # close_fds prevents concurrently started tests from inheriting
+            # (and holding open) each other's stdout pipes
+            main_pipe = Popen(args, stdin=stdin, stdout=PIPE,
+                              stderr=PIPE if stderr else devnull,
+                              cwd=tmp_dir, preexec_fn=setup_child,
+                              executable=executable, close_fds=True)
+            outputs = {main_pipe.stdout.fileno(): stdout}
+            if stderr:
+                outputs[main_pipe.stderr.fileno()] = stderr
+            for file_descriptor in outputs:
+                poll.register(file_descriptor,
+                              select.EPOLLIN | select.EPOLLHUP)
+            captured = 0
             start = time.time()
-            while do_poll:
+            while outputs:
                 remaining_time = start + time_limit - time.time()
                 if remaining_time <= 0:
-                    if main_pipe.poll() is None:  # Ensure it's still running
-                        # Kill the entire process group
-                        os.killpg(main_pipe.pid, signal.SIGKILL)
+                    # Kill the entire process tree, including any processes
+                    # left holding the output open after the main one exited
+                    running = wait_usage(main_pipe, start, usage,
+                                         block=False) is None
+                    kill_tree(main_pipe.pid)
+                    if running or remaining_time <= -TIMEOUT_GRACE:
+                        # Orphans that escaped the process group are adopted
+                        # by this process and can no longer be told apart
+                        # from other tests' so stop reading their output
+                        wait_usage(main_pipe, start, usage)
                         raise TimeoutException()
-                for file_descriptor, event in poll.poll(remaining_time):
-                    stdout.write(os.read(file_descriptor, 8192))
-                    if event == select.POLLHUP:
+                    remaining_time = min(1, TIMEOUT_GRACE + remaining_time)
+                for file_descriptor, _ in poll.poll(remaining_time):
+                    data = os.read(file_descriptor, 65536)
+                    output = outputs.get(file_descriptor)
+                    if not data:
                         poll.unregister(file_descriptor)
-                        do_poll = False
-            main_status = main_pipe.wait()
-            if main_status < 0:
+                        del outputs[file_descriptor]
+                        continue
+                    elif not output:  # Discard uncaptured output
+                        continue
+                    captured += len(data)
+                    if output_limit is not None and captured > output_limit:
+                        os.write(output.fileno(),
+                                 data[:len(data) - captured + output_limit])
+                        kill_group(main_pipe.pid)
+                        wait_usage(main_pipe, start, usage)
+                        if usage is not None:  # How much more is unknown
+                            usage['output_bytes'] = output_limit
+                        raise OutputLimitExceeded()
+                    os.write(output.fileno(), data)
+            main_status = wait_usage(main_pipe, start, usage)
+            kill_group(main_pipe.pid)  # Kill what the test left running
+            if usage is not None and (stdout or stderr):
+                usage['output_bytes'] = captured
+            if main_status == -signal.SIGXFSZ:
+                raise OutputLimitExceeded()
+            elif main_status < 0:
                 raise SignalException(-1 * main_status)
             return main_status
         except OSError as exc:
@@ -102,38 +431,107 @@ class Worker(object):
                 src = os.path.join(tmp_dir, save[0])
                 if os.path.isfile(src):
                     shutil.copy(src, save[1])
-            shutil.rmtree(tmp_dir)
+            devnull.close()
+            if template:
+                template.remove(tmp_dir)
+            else:
+                shutil.rmtree(tmp_dir)
 
-    def __init__(self):
+    def __init__(self, path='working', progress=None):
         # Load testable information
-        os.chdir('working')
+        self.home = os.getcwd()
+        os.chdir(path)
         with open('data.json') as fp:
             self.data = json.load(fp)
+        self.progress = progress or (lambda event, **info: None)
+        self.build_cache_status = None
+        self.compiler_cache_stats = None
+        self.template = None
 
     def run(self):
         # Build and run tests
         os.mkdir(RESULTS_PATH)
         result = {}
+        started = time.time()
         try:
             if self.data['make_target']:
+                start = time.time()
                 result['make'] = self.make_project(self.data['executable'],
                                                    self.data['make_target'])
-            self.run_tests(self.data['test_cases'])
+                result['make_time'] = time.time() - start
+                self.progress('make', status='success')
+            self.template = SandboxTemplate(
+                EXECUTION_FILES_PATH, link=self.data.get('sandbox_links'),
+                scratch_root=self.data.get('scratch_root'))
+            try:
+                self.run_tests(self.data['test_cases'])
+            finally:
+                self.template.close()
             result['status'] = 'success'
         except (MakeFailed, NonexistentExecutable) as exc:
             # Ignore invalid utf-8 characters
             result['make'] = exc.message.decode('utf-8', 'ignore')
             result['status'] = 'make_failed' if isinstance(exc, MakeFailed) \
                 else 'nonexistent_executable'
+            self.progress('make', status=result['status'])
+        result['duration'] = time.time() - started
+        if self.build_cache_status:
+            result['build_cache'] = self.build_cache_status
+        if self.compiler_cache_stats:
+            result['compiler_cache'] = self.compiler_cache_stats
         # Save results
         with open(os.path.join(RESULTS_PATH, 'testable'), 'w') as fp:
             json.dump(result, fp)
 
     def make_project(self, executable, target):
-        """Build the project and verify the executable exists."""
+        """Build the project and verify the executable exists.
+
+        When the `build_cache_size` option is set, identical builds are
+        restored from the build cache rather than running make. When the
+        `compiler_cache_size` option is set, make runs with a CompilerCache
+        and `make_jobs` sets the number of jobs make runs at once.
+
+        """
+        cache = None
+        if self.data.get('build_cache_size'):
+            cache = BuildCache(os.path.join(self.home, BUILD_CACHE_PATH),
+                               max_size=self.data['build_cache_size'])
+            key = cache.key(target)
+            meta = cache.fetch(key, SRC_PATH)
+            if meta:
+                self.build_cache_status = 'hit'
+                output = meta['output'].encode('utf-8')
+                if meta['status'] != 'success':
+                    raise MakeFailed(output)
+                if not os.path.isfile(os.path.join(SRC_PATH, executable)):
+                    raise NonexistentExecutable(output)
+                return output
+            self.build_cache_status = 'miss'
+            before = snapshot(SRC_PATH)
+
         command = 'make -f ../Makefile -C {0} {1}'.format(SRC_PATH, target)
-        pipe = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT)
+        if self.data.get('make_jobs', 1) > 1:
+            command += ' -j {0}'.format(int(self.data['make_jobs']))
+        env = None
+        compiler_cache = None
+        if self.data.get('compiler_cache_size'):
+            compiler_cache = CompilerCache(
+                os.path.join(self.home, COMPILER_CACHE_PATH),
+                max_size=self.data['compiler_cache_size'])
+            if compiler_cache.ccache:
+                env = compiler_cache.environment(SRC_PATH)
+                stats = compiler_cache.stats()
+        pipe = Popen(command, shell=True, stdout=PIPE, stderr=STDOUT, env=env)
         output = pipe.communicate()[0]
+        if env:
+            self.compiler_cache_stats = {
+                x: y - stats[x] for x, y in compiler_cache.stats().items()}
+        if cache:
+            after = snapshot(SRC_PATH)
+            built = [x for x in after if before.get(x) != after[x]
+                     and not os.path.islink(os.path.join(SRC_PATH, x))]
+            cache.store(key, 'success' if pipe.returncode == 0 else
+                        'make_failed', output, SRC_PATH, built)
         if pipe.returncode != 0:
             raise MakeFailed(output)
         if not os.path.isfile(os.path.join(SRC_PATH, executable)):
@@ -141,29 +539,59 @@ class Worker(object):
         return output
 
     def run_tests(self, test_cases):
+        """Run the test cases and save their results.
+
+        When the `parallel` option is set, test cases are run concurrently on
+        a pool sized to the number of cores. Each test case already runs in
+        its own temporary directory and process group so the results are the
+        same as when run serially. Processes left behind by a serial test
+        case are killed before the next one starts.
+
+        """
+        if self.data.get('parallel') and len(test_cases) > 1:
+            pool = ThreadPool(min(cpu_count(), len(test_cases)))
+            try:
+                tc_results = pool.map(self.run_test_case, test_cases)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            tc_results = []
+            for tc in test_cases:
+                tc_results.append(self.run_test_case(tc))
+                kill_descendants()
+        results = {tc['id']: result for tc, result
+                   in zip(test_cases, tc_results)}
+        with open(os.path.join(RESULTS_PATH, 'test_cases'), 'w') as fp:
+            json.dump(results, fp)
+
+    def run_test_case(self, tc):
+        """Run a single test case and return its result."""
         def execute(*args, **kwargs):
             try:
-                result['extra'] = self.execute(*args, **kwargs)
+                result['extra'] = self.execute(*args, template=self.template,
+                                               usage=result, **kwargs)
                 result['status'] = 'success'
             except NonexistentExecutable:
                 result['status'] = 'nonexistent_executable'
+            except OutputLimitExceeded:
+                result['status'] = 'output_limit_exceeded'
             except SignalException as exc:
                 result['extra'] = exc.signum
                 result['status'] = 'signal'
             except TimeoutException:
                 result['status'] = 'timed_out'
 
-        results = {}
-        for tc in test_cases:
-            output_file = os.path.join(RESULTS_PATH, 'tc_{0}'.format(tc['id']))
-            if tc['stdin']:
-                stdin_file = os.path.join(INPUT_PATH, tc['stdin'])
-                stdin = open(stdin_file)
-            else:
-                stdin = None
-            result = {'extra': None}
+        output_file = os.path.join(RESULTS_PATH, 'tc_{0}'.format(tc['id']))
+        if tc['stdin']:
+            stdin_file = os.path.join(INPUT_PATH, tc['stdin'])
+            stdin = open(stdin_file)
+        else:
+            stdin = None
+        result = {'extra': None}
 
-            max_file_size = MAX_FILE_SIZE
+        max_file_size = MAX_FILE_SIZE
+        try:
             # Mange output file
             if tc['source'] != 'file':
                 with open(output_file, 'wb') as output:
@@ -174,29 +602,449 @@ class Worker(object):
                         stdout = None
                         stderr = output
                     execute(tc['args'], stderr=stderr, stdin=stdin,
-                            stdout=stdout)
+                            stdout=stdout, output_limit=max_file_size,
+                            time_limit=tc.get('time_limit'))
             else:
-                execute(tc['args'], save=(tc['output_filename'], output_file))
+                execute(tc['args'], save=(tc['output_filename'], output_file),
+                        time_limit=tc.get('time_limit'))
                 if tc['output_filename'].endswith('.png'):
                     max_file_size = 131072  # Avoid truncating images
+        finally:
+            if stdin:
+                stdin.close()
 
-            if not os.path.isfile(output_file):
-                # Hack on this status until we update the ENUM
-                if result['status'] == 'success':
-                    # Don't overwrite other statuses
-                    result['status'] = 'output_limit_exceeded'
-            elif os.path.getsize(output_file) > max_file_size:
-                # Truncate output file size
-                print('\ttruncating outputfile', os.path.getsize(output_file))
-                fd = os.open(output_file, os.O_WRONLY)
-                os.ftruncate(fd, max_file_size)
-                os.close(fd)
-                if result['status'] == 'success':
-                    # Don't overwrite other statuses
-                    result['status'] = 'output_limit_exceeded'
-            results[tc['id']] = result
-        with open(os.path.join(RESULTS_PATH, 'test_cases'), 'w') as fp:
-            json.dump(results, fp)
+        if 'output_bytes' not in result:
+            result['output_bytes'] = os.path.getsize(output_file) \
+                if os.path.isfile(output_file) else 0
+        if not os.path.isfile(output_file):
+            # Hack on this status until we update the ENUM
+            if result['status'] == 'success':
+                # Don't overwrite other statuses
+                result['status'] = 'output_limit_exceeded'
+        elif os.path.getsize(output_file) > max_file_size:
+            # Truncate output file size
+            print('\ttruncating outputfile', os.path.getsize(output_file))
+            fd = os.open(output_file, os.O_WRONLY)
+            os.ftruncate(fd, max_file_size)
+            os.close(fd)
+            if result['status'] == 'success':
+                # Don't overwrite other statuses
+                result['status'] = 'output_limit_exceeded'
+        self.progress('test_case', id=tc['id'], status=result['status'])
+        return result
+
+
+class BuildCache(object):
+
+    """A persistent cache of build results keyed by the build's sources.
+
+    The key is derived from the Makefile's sha1, the sorted (filename, sha1)
+    pairs of the files in the source directory and the make target. An entry
+    records the make status and output along with every file the build
+    created or modified, so that a hit restores the build without running
+    make. Failed builds are cached as well.
+
+    """
+
+    def __init__(self, path=BUILD_CACHE_PATH, max_size=CACHE_SIZE):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    @staticmethod
+    def key(target):
+        """Return the cache key for building target in the current job."""
+        digest = sha1()
+        makefile = file_sha1('Makefile') if os.path.isfile('Makefile') else ''
+        digest.update('{0}\0{1}\0'.format(makefile, target))
+        for filename in sorted(snapshot(SRC_PATH)):
+            digest.update('{0}\0{1}\0'.format(
+                filename, file_sha1(os.path.join(SRC_PATH, filename))))
+        return digest.hexdigest()
+
+    def evict(self):
+        """Remove least recently used entries until within the size limit."""
+        entries = []
+        total = 0
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            if not os.path.isdir(entry):
+                continue
+            size = directory_size(entry)
+            entries.append((os.stat(entry).st_mtime, size, entry))
+            total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def fetch(self, key, dst):
+        """Restore the entry for key into dst and return its metadata.
+
+        Return None when there is no entry for key.
+
+        """
+        entry = os.path.join(self.path, key)
+        if not os.path.isdir(entry):
+            self.record(hit=False)
+            return None
+        with open(os.path.join(entry, 'meta.json')) as fp:
+            meta = json.load(fp)
+        files = os.path.join(entry, 'files')
+        for filename in snapshot(files):
+            target = os.path.join(dst, filename)
+            if os.path.lexists(target):
+                os.remove(target)  # The target may be a read-only hardlink
+            elif not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copy2(os.path.join(files, filename), target)
+        os.utime(entry, None)  # Mark as recently used
+        self.record(hit=True)
+        return meta
+
+    def record(self, hit):
+        """Update the persistent hit and miss counters."""
+        stats_file = os.path.join(self.path, 'stats.json')
+        stats = {'hits': 0, 'misses': 0}
+        if os.path.isfile(stats_file):
+            with open(stats_file) as fp:
+                stats.update(json.load(fp))
+        stats['hits' if hit else 'misses'] += 1
+        with open(stats_file, 'w') as fp:
+            json.dump(stats, fp)
+
+    def store(self, key, status, output, src, filenames):
+        """Store the build outcome and the built files under key."""
+        tmp_dir = tempfile.mkdtemp(dir=self.path)
+        for filename in filenames:
+            target = os.path.join(tmp_dir, 'files', filename)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copy2(os.path.join(src, filename), target)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fp:
+            json.dump({'output': output.decode('utf-8', 'ignore'),
+                       'status': status}, fp)
+        try:
+            os.rename(tmp_dir, os.path.join(self.path, key))
+        except OSError:  # Another build stored the same key
+            shutil.rmtree(tmp_dir)
+        self.evict()
+
+
+class CompilerCache(object):
+
+    """Share compiler output between builds through ccache.
+
+    Builds run with the directory of compiler links to ccache first in their
+    PATH. ccache keys its entries on the preprocessed source and the
+    compiler's flags, thus the unchanged translation units of a build, such
+    as the instructor's build files, are never recompiled. Paths within the
+    build directory are hashed relative to it so that identical sources
+    built in another job's directory still hit the cache.
+
+    """
+
+    COMPILERS = ('c++', 'cc', 'clang', 'clang++', 'g++', 'gcc')
+    # Statistic names of `ccache --print-stats` and of `ccache -s`
+    STATS = {'direct_cache_hit': 'hits', 'preprocessed_cache_hit': 'hits',
+             'cache_miss': 'misses', 'cache hit (direct)': 'hits',
+             'cache hit (preprocessed)': 'hits', 'cache miss': 'misses'}
+
+    def __init__(self, path=COMPILER_CACHE_PATH, max_size=CACHE_SIZE):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.ccache = None
+        for directory in os.environ.get('PATH', '').split(os.pathsep):
+            executable = os.path.join(directory, 'ccache')
+            if os.access(executable, os.X_OK):
+                self.ccache = executable
+                break
+
+    def _environment(self):
+        return dict(os.environ, CCACHE_DIR=os.path.join(self.path, 'cache'),
+                    CCACHE_MAXSIZE='{0}k'.format(self.max_size // 1024))
+
+    def environment(self, build_dir):
+        """Return the environment for running a build in build_dir."""
+        bin_dir = os.path.join(self.path, 'bin')
+        if not os.path.isdir(bin_dir):
+            os.makedirs(bin_dir)
+            for compiler in self.COMPILERS:
+                os.symlink(self.ccache, os.path.join(bin_dir, compiler))
+        env = self._environment()
+        env.update(CCACHE_BASEDIR=os.path.abspath(build_dir),
+                   CCACHE_NOHASHDIR='1',
+                   PATH=os.pathsep.join([bin_dir, os.environ.get('PATH',
+                                                                 '')]))
+        return env
+
+    def stats(self):
+        """Return the cache's total number of hits and misses."""
+        totals = {'hits': 0, 'misses': 0}
+        for args in (['--print-stats'], ['-s']):  # ccache 4 and older
+            pipe = Popen([self.ccache] + args, stdout=PIPE, stderr=PIPE,
+                         env=self._environment())
+            output = pipe.communicate()[0]
+            if pipe.returncode == 0:
+                break
+        for line in output.splitlines():
+            parts = line.rsplit(None, 1)
+            if len(parts) == 2 and parts[0].strip() in self.STATS \
+                    and parts[1].isdigit():
+                totals[self.STATS[parts[0].strip()]] += int(parts[1])
+        return totals
+
+
+class FileCache(object):
+
+    """A persistent sha1-addressed store of job input files.
+
+    Blobs are stored read-only and job directories are built from them using
+    hardlinks, except for the source files, which are copied as the build
+    (running as the cache's owner) could otherwise make a blob writable and
+    modify it for every later job. Each use of a blob refreshes its
+    modification time so that the least recently used blobs are evicted once
+    the cache grows beyond its maximum size.
+
+    """
+
+    def __init__(self, path=CACHE_PATH, max_size=CACHE_SIZE):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+
+    def add(self, sha1, src):
+        """Move the file src into the cache as blob sha1."""
+        dst = self.blob_path(sha1)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        os.chmod(src, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.rename(src, dst)
+
+    def blob_path(self, sha1):
+        return os.path.join(self.path, sha1[:2], sha1[2:])
+
+    def evict(self, keep=()):
+        """Remove least recently used blobs until within the size limit."""
+        entries = []
+        total = 0
+        for root, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                info = os.stat(path)
+                digest = os.path.basename(root) + filename
+                entries.append((info.st_mtime, info.st_size, path, digest))
+                total += info.st_size
+        for _, size, path, digest in sorted(entries):
+            if total <= self.max_size:
+                break
+            if digest not in keep:
+                os.remove(path)
+                total -= size
+
+    def add_blobs(self, path):
+        """Add every blob in the directory path to the cache."""
+        if os.path.isdir(path):
+            for digest in os.listdir(path):
+                self.add(digest, os.path.join(path, digest))
+
+    def load(self, incoming=INCOMING_PATH, path='working', keep=()):
+        """Build the job directory `path` from the manifest in `incoming`.
+
+        Blobs pushed alongside the manifest are first added to the cache. The
+        blobs in `keep` are, in addition to the job's, exempt from eviction.
+
+        """
+        with open(os.path.join(incoming, 'data.json')) as fp:
+            data = json.load(fp)
+        self.add_blobs(os.path.join(incoming, 'blobs'))
+        files = data['files']
+        missing = self.missing(files.values())
+        if missing:
+            raise Exception('Files missing from the cache: {0}'
+                            .format(', '.join(sorted(missing))))
+        self.materialize(files, path)
+        shutil.copy(os.path.join(incoming, 'data.json'),
+                    os.path.join(path, 'data.json'))
+        self.max_size = data.get('cache_size', self.max_size)
+        self.evict(keep=set(files.values()) | set(keep))
+
+    def materialize(self, files, path):
+        """Create path containing the mapping of filenames to blobs."""
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        for directory in (SRC_PATH, INPUT_PATH, EXECUTION_FILES_PATH):
+            os.makedirs(os.path.join(path, directory))
+        now = time.time()
+        for filename, digest in files.items():
+            blob = self.blob_path(digest)
+            os.utime(blob, (now, now))  # Mark as recently used
+            dst = os.path.join(path, filename)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if filename.startswith(SRC_PATH + os.sep):
+                copy_writable(blob, dst)
+                continue
+            try:
+                os.link(blob, dst)
+            except OSError as exc:
+                if exc.errno != errno.EXDEV:
+                    raise
+                shutil.copy(blob, dst)
+
+    def missing(self, sha1s):
+        """Return the set of sha1s that are not in the cache."""
+        return set(x for x in sha1s if not os.path.isfile(self.blob_path(x)))
+
+
+class Agent(object):
+
+    """Serve jobs received as framed messages over a long-lived channel.
+
+    The agent is started once per machine (typically via `ssh ... python
+    worker.py agent`) and reuses the Worker logic for every job it receives,
+    avoiding the cost of a new ssh session and interpreter per job.
+
+    """
+
+    def __init__(self, infile, outfile):
+        self.infile = infile
+        self.outfile = outfile
+        self.lock = threading.Lock()
+
+    def progress(self, event, **info):
+        info.update(type='progress', event=event)
+        self.send(info)
+
+    def send(self, message):
+        # Test cases may report progress concurrently
+        with self.lock:
+            write_frame(self.outfile, message)
+
+    def serve(self):
+        base = os.getcwd()
+        while True:
+            message = read_frame(self.infile)
+            if message is None:
+                return 0
+            if message['command'] == 'ping':
+                self.send({'type': 'pong'})
+                continue
+            elif message['command'] == 'missing':
+                missing = FileCache().missing(message['sha1s'])
+                self.send({'type': 'missing', 'missing': sorted(missing)})
+                continue
+            reply = {'type': 'result', 'status': 'failed'}
+            try:
+                kill_strays()
+                if message['command'] == 'batch':
+                    path = message.get('path', 'working')
+                    reply['statuses'] = run_batch(
+                        path, incoming=message.get('incoming'),
+                        progress=self.progress)
+                    reply['results'] = base64.b64encode(
+                        pack_results(path, reply['statuses']))
+                    reply['status'] = 'success'
+                else:
+                    reply['status'] = run_job(
+                        message.get('path', 'working'),
+                        incoming=message.get('incoming'),
+                        progress=self.progress)
+            except Exception:
+                reply['error'] = traceback.format_exc()
+            finally:
+                os.chdir(base)
+            self.send(reply)
+
+
+class SandboxTemplate(object):
+
+    """A prepared copy of the execution files shared by every test case.
+
+    The files in `path` are copied once per testable into a template
+    directory below `scratch_root` (the default temporary directory when not
+    set), and each test case's sandbox is populated from the template. When
+    `link` is set the sandboxes receive write-protected hardlinks to the
+    template's files instead of copies, falling back to copies when linking
+    fails. As the owner of a hardlink can make it writable again, the
+    template is checked after every test case and rebuilt when modified.
+    Since making and removing the links also changes the files' ctime, both
+    happen while holding the lock, with the template checked before and its
+    signature refreshed after.
+
+    """
+
+    def __init__(self, path, link=False, scratch_root=None):
+        self.path = path
+        self.link = link
+        self.scratch_root = scratch_root
+        self.lock = threading.Lock()
+        self.stats = None
+        self.template = None
+        self.build()
+
+    def _check(self):
+        """Rebuild the template if its files were modified (lock held)."""
+        if snapshot(self.template) != self.stats:
+            log_msg('rebuilding modified sandbox template')
+            self.build()
+
+    def build(self):
+        if self.template:
+            shutil.rmtree(self.template)
+        self.template = tempfile.mkdtemp(prefix='template_',
+                                         dir=self.scratch_root)
+        for filename in os.listdir(self.path):
+            dst = os.path.join(self.template, filename)
+            copy_writable(os.path.join(self.path, filename), dst)
+            if self.link:
+                os.chmod(dst, stat.S_IMODE(os.stat(dst).st_mode) &
+                         ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        self.stats = snapshot(self.template)
+
+    def close(self):
+        shutil.rmtree(self.template)
+
+    def create(self):
+        """Return a new sandbox directory populated from the template."""
+        sandbox = tempfile.mkdtemp(dir=self.scratch_root)
+        with self.lock:
+            if self.link:
+                self._check()
+            for filename in os.listdir(self.template):
+                src = os.path.join(self.template, filename)
+                dst = os.path.join(sandbox, filename)
+                if self.link:
+                    try:
+                        os.link(src, dst)
+                        continue
+                    except OSError:  # e.g., EXDEV or EPERM
+                        pass
+                copy_writable(src, dst)
+            if self.link:
+                self.stats = snapshot(self.template)
+        return sandbox
+
+    def remove(self, sandbox):
+        """Remove a sandbox returned by create, checking the template first.
+
+        The template is rebuilt if a test case modified any of its files.
+
+        """
+        if self.link:
+            with self.lock:
+                self._check()
+                for filename in os.listdir(self.template):
+                    path = os.path.join(sandbox, filename)
+                    try:
+                        if os.path.samefile(
+                                path, os.path.join(self.template, filename)):
+                            os.remove(path)
+                    except OSError:  # The test case removed it
+                        pass
+                self.stats = snapshot(self.template)
+        shutil.rmtree(sandbox)
 
 
 class MakeFailed(Exception):
@@ -207,6 +1055,10 @@ class NonexistentExecutable(Exception):
     """Indicate that the expected binary does not exist."""
 
 
+class OutputLimitExceeded(Exception):
+    """Indicate that a process produced more output than allowed."""
+
+
 class SignalException(Exception):
     """Indicate that a process was terminated via a signal"""
     def __init__(self, signum):
@@ -217,24 +1069,95 @@ class TimeoutException(Exception):
     """Indicate that a process's execution timed out."""
 
 
-def main():
-    with open('worker.log', 'a') as fp:
-        wp = Worker()
+def run_batch(path='working', incoming=None, progress=None):
+    """Run every job of the bundle in path and return their statuses.
+
+    Each job has its own subdirectory of the bundle (and of `incoming` when
+    provided, whose `blobs` directory is shared by all of the jobs). A job
+    that fails does not prevent the others from running.
+
+    """
+    base = os.getcwd()
+    names = sorted(x for x in os.listdir(incoming or path) if x != 'blobs')
+    if incoming:
+        cache = FileCache()
+        cache.add_blobs(os.path.join(incoming, 'blobs'))
+        keep = set()  # Don't evict the blobs of jobs yet to be materialized
+        for name in names:
+            with open(os.path.join(incoming, name, 'data.json')) as fp:
+                keep.update(json.load(fp)['files'].values())
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    statuses = {}
+    for name in names:
+        statuses[name] = 'failed'
+        try:
+            if incoming:
+                cache.load(os.path.join(incoming, name),
+                           os.path.join(path, name), keep=keep)
+            statuses[name] = run_job(os.path.join(path, name),
+                                     progress=progress)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os.chdir(base)
+    return statuses
+
+
+def run_job(path='working', incoming=None, progress=None):
+    """Run the job in path and log its outcome to worker.log.
+
+    When `incoming` is provided, path is first built from the manifest (and
+    any new blobs) pushed there. Every process started by the job is killed
+    once it ends.
+
+    """
+    if incoming:
+        FileCache().load(incoming, path)
+    with open(os.path.abspath('worker.log'), 'a') as fp:
+        wp = Worker(path, progress=progress)
         status = 'failed'
         start = time.time()
         try:
             wp.run()
             status = 'success'
-            return 0
+            return status
         except Exception:
             traceback.print_exc(file=fp)
             raise
         finally:
+            kill_descendants()
             fp.write('{date} {key} {machine} {status} in {delta} seconds\n'
                      .format(date=datetime.now(), key=wp.data['key'],
                              machine=socket.gethostname(),
                              status=status, delta=time.time() - start))
 
 
+def main():
+    set_subreaper()
+    if sys.argv[1:] == ['agent']:
+        # Reserve the original stdout for the channel and send anything else
+        # written to stdout to stderr
+        channel = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        return Agent(sys.stdin, channel).serve()
+    elif sys.argv[1:2] == ['batch']:
+        # The results are streamed on the original stdout
+        channel = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        if 'shared' not in sys.argv[2:]:  # The account runs only this worker
+            kill_strays()
+        statuses = run_batch(incoming=INCOMING_PATH
+                             if 'cached' in sys.argv[2:] else None)
+        channel.write(pack_results('working', statuses))
+        channel.close()
+        return 0
+    elif sys.argv[1:2] == ['missing']:
+        print(json.dumps(sorted(FileCache().missing(sys.argv[2:]))))
+        return 0
+    run_job()
+    return 0
+
+
 if __name__ == '__main__':
     sys.exit(main())